@@ -20,6 +20,7 @@ from machina.vfuncs import DeterministicSVfunc
 from machina.envs import GymEnv, C2DEnv
 from machina.traj import Traj
 from machina.traj import epi_functional as ef
+from machina.traj import traj_functional as tf
 from machina.samplers import EpiSampler
 from machina import logger
 from machina.utils import measure, set_device
@@ -148,12 +149,13 @@ while args.max_epis > total_epi:
         traj.add_epis(epis)
 
         traj = ef.compute_vs(traj, vf)
-        traj = ef.compute_rets(traj, args.gamma)
-        traj = ef.compute_advs(traj, args.gamma, args.lam)
-        traj = ef.centerize_advs(traj)
         traj = ef.compute_h_masks(traj)
         traj.register_epis()
 
+        traj = tf.compute_rets(traj, args.gamma)
+        traj = tf.compute_advs(traj, args.gamma, args.lam)
+        traj = tf.centerize_advs(traj)
+
         if args.data_parallel:
             pol.dp_run = True
             vf.dp_run = True
@@ -130,7 +130,7 @@ optim_vf = torch.optim.Adam(vf_net.parameters(), args.vf_lr)
 optim_qf = torch.optim.Adam(qf_net.parameters(), args.qf_lr)
 optim_alpha = torch.optim.Adam([log_alpha], args.pol_lr)
 
-off_traj = Traj(args.max_steps_off)
+off_traj = Traj(args.max_steps_off, ring_buffer=True, lazy_next_obs=True)
 
 total_epi = 0
 total_step = 0
@@ -141,7 +141,7 @@ while args.max_epis > total_epi:
         epis = sampler.sample(pol, max_steps=args.max_steps_per_iter)
 
     with measure('train'):
-        on_traj = Traj()
+        on_traj = Traj(lazy_next_obs=True)
         on_traj.add_epis(epis)
 
         on_traj = ef.add_next_obs(on_traj)
@@ -132,7 +132,8 @@ sampler = EpiSampler(env, pol, num_parallel=args.num_parallel, seed=args.seed)
 
 optim_qf = torch.optim.Adam(qf_net.parameters(), args.qf_lr)
 
-off_traj = Traj(args.max_steps_off, traj_device='cpu')
+off_traj = Traj(args.max_steps_off, traj_device='cpu',
+                ring_buffer=True, lazy_next_obs=True)
 
 total_epi = 0
 total_step = 0
@@ -144,7 +145,7 @@ while args.max_epis > total_epi:
     with measure('sample'):
         epis = sampler.sample(pol, max_steps=args.max_steps_per_iter)
     with measure('train'):
-        on_traj = Traj(traj_device='cpu')
+        on_traj = Traj(traj_device='cpu', lazy_next_obs=True)
         on_traj.add_epis(epis)
 
         on_traj = ef.add_next_obs(on_traj)
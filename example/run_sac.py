@@ -127,7 +127,8 @@ optim_qf2 = torch.optim.Adam(qf_net2.parameters(), args.qf_lr)
 optim_qfs = [optim_qf1, optim_qf2]
 optim_alpha = torch.optim.Adam([log_alpha], args.pol_lr)
 
-off_traj = Traj(args.max_steps_off, traj_device='cpu')
+off_traj = Traj(args.max_steps_off, traj_device='cpu',
+                ring_buffer=True, lazy_next_obs=True)
 
 total_epi = 0
 total_step = 0
@@ -138,7 +139,7 @@ while args.max_epis > total_epi:
         epis = sampler.sample(pol, max_steps=args.max_steps_per_iter)
 
     with measure('train'):
-        on_traj = Traj(traj_device='cpu')
+        on_traj = Traj(traj_device='cpu', lazy_next_obs=True)
         on_traj.add_epis(epis)
 
         on_traj = ef.add_next_obs(on_traj)
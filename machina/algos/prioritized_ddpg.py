@@ -25,7 +25,8 @@ def train(traj,
         qf_bellman_loss = lf.bellman(
             qf, targ_qf, targ_pol, batch, gamma, reduction='none')
         td_loss = torch.sqrt(qf_bellman_loss*2)
-        qf_bellman_loss = torch.mean(qf_bellman_loss)
+        # correcting bias of prioritized sampling
+        qf_bellman_loss = torch.mean(batch['is_weights'] * qf_bellman_loss)
         optim_qf.zero_grad()
         qf_bellman_loss.backward()
         optim_qf.step()
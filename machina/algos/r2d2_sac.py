@@ -92,11 +92,10 @@ def train(traj,
 
         # update seq_pris
         train_length = seq_length - burn_in_length
-        for i in range(batch_size):
-            start = start_indices[i] + burn_in_length
-            seq_indices = torch.arange(start, start+train_length-1)
-            traj = tf.update_pris(
-                traj, td_losses[:, i], seq_indices, update_epi_pris=True, seq_length=seq_length)
+        seq_indices = start_indices.unsqueeze(
+            0) + burn_in_length + torch.arange(train_length-1).unsqueeze(1)
+        traj = tf.update_pris(
+            traj, td_losses, seq_indices, update_epi_pris=True, seq_length=seq_length)
 
     logger.log("Optimization finished!")
 
@@ -31,8 +31,12 @@ class RandomPol(BasePol):
                          data_parallel=data_parallel, parallel_dim=parallel_dim)
 
     def forward(self, ob):
+        batch_shape = ()
+        if isinstance(ob, torch.Tensor) and self.observation_space.shape is not None:
+            batch_shape = tuple(
+                ob.shape[:ob.dim() - len(self.observation_space.shape)])
         ac_real = np.random.uniform(
-            self.action_space.low, self.action_space.high, self.action_space.shape).astype(np.float32)
+            self.action_space.low, self.action_space.high, batch_shape + self.action_space.shape).astype(np.float32)
         ac = torch.tensor(ac_real)
         mean = torch.zeros_like(ac)
         return ac_real, ac, dict(mean=mean)
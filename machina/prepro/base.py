@@ -1,6 +1,8 @@
 import numpy as np
 import torch
 
+from machina.prepro.running_mean_std import RunningMeanStd
+
 
 class BasePrePro(object):
     """
@@ -16,25 +18,38 @@ class BasePrePro(object):
         self.observation_space = observation_space
         self.normalize_ob = normalize_ob
         if self.normalize_ob:
-            self.ob_rm = np.zeros(self.observation_space.shape)
-            self.ob_rv = np.ones(self.observation_space.shape)
-            self.alpha = 0.001
+            self.ob_rms = RunningMeanStd(self.observation_space.shape)
+
+    @property
+    def ob_rm(self):
+        return self.ob_rms.mean
+
+    @property
+    def ob_rv(self):
+        return self.ob_rms.var
+
+    def share_memory(self):
+        """
+        Sharing running mean and running variance
+        with sampling processes which this is given to.
+        """
+        if self.normalize_ob:
+            self.ob_rms.share_memory()
+        return self
 
     def update_ob_rms(self, ob):
         """
         Updating running mean and running variance.
+        A batch of observations can also be given.
         """
-        self.ob_rm = self.ob_rm * (1-self.alpha) + self.alpha * ob
-        self.ob_rv = self.ob_rv * (1-self.alpha) + \
-            self.alpha * np.square(ob-self.ob_rm)
+        self.ob_rms.update(ob)
 
     def prepro(self, ob):
         """
         Applying preprocess to observations.
         """
         if self.normalize_ob:
-            ob = (ob - self.ob_rm) / (np.sqrt(self.ob_rv) + 1e-8)
-            ob = np.clip(ob, -5, 5)
+            ob = self.ob_rms.normalize(ob, clip=5)
         return ob
 
     def prepro_with_update(self, ob):
@@ -43,6 +58,5 @@ class BasePrePro(object):
         """
         if self.normalize_ob:
             self.update_ob_rms(ob)
-            ob = (ob - self.ob_rm) / (np.sqrt(self.ob_rv) + 1e-8)
-            ob = np.clip(ob, -5, 5)
+            ob = self.ob_rms.normalize(ob, clip=5)
         return ob
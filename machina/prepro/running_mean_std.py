@@ -0,0 +1,171 @@
+from multiprocessing.context import get_spawning_popen
+
+import numpy as np
+import torch
+import torch.multiprocessing as mp
+
+
+class RunningMeanStd(object):
+    """
+    Running mean and variance.
+    Moments of batches are merged by the parallel algorithm of Chan et al.,
+    so statistics can be updated by batches and merged with statistics
+    computed in other sampling processes or nodes.
+
+    Parameters
+    ----------
+    shape : tuple
+        Shape of an item.
+    """
+
+    def __init__(self, shape=()):
+        self.shape = tuple(shape)
+        self._mean = torch.zeros(self.shape, dtype=torch.float64)
+        self._var = torch.ones(self.shape, dtype=torch.float64)
+        self._count = torch.zeros((), dtype=torch.float64)
+        self._lock = None
+
+    @property
+    def mean(self):
+        return self._mean.numpy()
+
+    @property
+    def var(self):
+        return self._var.numpy()
+
+    @property
+    def count(self):
+        return float(self._count)
+
+    def std(self, eps=0.):
+        return np.sqrt(self.var) + eps
+
+    def share_memory(self):
+        """
+        Moving statistics to shared memory.
+        Sampling processes given this object update the same statistics.
+
+        Returns
+        -------
+        rms : RunningMeanStd
+        """
+        self._mean.share_memory_()
+        self._var.share_memory_()
+        self._count.share_memory_()
+        self._lock = mp.Lock()
+        return self
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        # locks can only be pickled for processes being spawned, e.g. not by cloudpickle
+        if state['_lock'] is not None and get_spawning_popen() is None:
+            state['_lock'] = None
+            state['_shared'] = True
+        return state
+
+    def __setstate__(self, state):
+        if state.pop('_shared', False):
+            state['_lock'] = mp.Lock()
+        self.__dict__.update(state)
+
+    def _merge(self, mean, var, count):
+        total = self.count + count
+        delta = mean - self.mean
+        m2 = self.var * self.count + var * count + \
+            np.square(delta) * self.count * count / total
+        self._mean.copy_(torch.from_numpy(
+            np.asarray(self.mean + delta * count / total)))
+        self._var.copy_(torch.from_numpy(np.asarray(m2 / total)))
+        self._count.fill_(total)
+
+    def update_from_moments(self, mean, var, count):
+        """
+        Merging mean and variance of count items.
+
+        Parameters
+        ----------
+        mean : ndarray
+        var : ndarray
+        count : int
+        """
+        if count == 0:
+            return
+        mean = np.asarray(mean, dtype=np.float64)
+        var = np.asarray(var, dtype=np.float64)
+        if self._lock is None:
+            self._merge(mean, var, count)
+        else:
+            with self._lock:
+                self._merge(mean, var, count)
+
+    def update(self, xs):
+        """
+        Merging a batch.
+
+        Parameters
+        ----------
+        xs : ndarray or torch.Tensor
+            Shape of xs is (batch_size, ) + shape or shape.
+        """
+        if isinstance(xs, torch.Tensor):
+            xs = xs.detach().double().reshape((-1, ) + self.shape)
+            mean = xs.mean(dim=0).cpu().numpy()
+            var = xs.var(dim=0, unbiased=False).cpu().numpy()
+        else:
+            xs = np.asarray(xs, dtype=np.float64).reshape((-1, ) + self.shape)
+            mean = np.mean(xs, axis=0)
+            var = np.var(xs, axis=0)
+        self.update_from_moments(mean, var, len(xs))
+
+    def merge(self, other):
+        """
+        Merging statistics of another RunningMeanStd.
+
+        Parameters
+        ----------
+        other : RunningMeanStd
+        """
+        self.update_from_moments(other.mean, other.var, other.count)
+
+    def normalize(self, xs, eps=1e-8, clip=None):
+        """
+        Normalizing xs by mean and standard deviation.
+
+        Parameters
+        ----------
+        xs : ndarray
+        eps : float
+            Small value added to standard deviation.
+        clip : float or None
+            If not None, normalized values are clipped in [-clip, clip].
+
+        Returns
+        -------
+        xs : ndarray
+        """
+        xs = (xs - self.mean) / self.std(eps)
+        if clip is not None:
+            xs = np.clip(xs, -clip, clip)
+        return xs
+
+    def normalize_(self, xs, eps=1e-8, clip=None):
+        """
+        Normalizing a tensor in place.
+
+        Parameters
+        ----------
+        xs : torch.Tensor
+        eps : float
+            Small value added to standard deviation.
+        clip : float or None
+            If not None, normalized values are clipped in [-clip, clip].
+
+        Returns
+        -------
+        xs : torch.Tensor
+        """
+        xs.sub_(torch.as_tensor(self.mean, dtype=xs.dtype, device=xs.device))
+        xs.div_(torch.as_tensor(self.std(eps), dtype=xs.dtype, device=xs.device))
+        if clip is not None:
+            xs.clamp_(-clip, clip)
+        return xs
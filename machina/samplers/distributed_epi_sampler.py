@@ -4,13 +4,22 @@ This sampler uses redis for the backend.
 """
 
 import argparse
-import time
 
 import cloudpickle
 import redis
 
 from machina.samplers import EpiSampler
-from machina.utils import _int, get_redis, make_redis
+from machina.samplers.param_store import decode_params, encode_params, flatten, unflatten
+from machina.traj.wire import dumps_epis, loads_epis
+from machina.utils import get_redis, make_redis
+
+
+SCATTER_KEYS = ('env', 'pol', 'num_parallel', 'prepro', 'seed')
+GATHER_KEYS = ('epis', )
+
+
+def _task_key(iteration):
+    return 'task' + "_{}".format(iteration)
 
 
 class DistributedEpiSampler(object):
@@ -29,9 +38,20 @@ class DistributedEpiSampler(object):
         Number of processes
     prepro : Prepro
     seed : int
+    param_dtype : str
+        'float32' or 'float16'. Parameters of pol are sent to nodes in this dtype.
+    param_delta : bool
+        If True, only parameters updated since the last sampling are sent to nodes.
+    stream_interval : float
+        Seconds between which nodes send finished episodes to master.
+    compress : str or None
+        None, 'lz4' or 'zstd'. Episodes are compressed by it.
+    obs_dtype : str or None
+        If not None, observations are sent in this dtype, e.g. 'float16'.
     """
 
-    def __init__(self, world_size, rank=-1, env=None, pol=None, num_parallel=8, prepro=None, seed=256):
+    def __init__(self, world_size, rank=-1, env=None, pol=None, num_parallel=8, prepro=None, seed=256,
+                 param_dtype='float32', param_delta=True, stream_interval=0.1, compress=None, obs_dtype=None):
         if rank < 0:
             assert env is not None and pol is not None
 
@@ -46,9 +66,20 @@ class DistributedEpiSampler(object):
             self.num_parallel = num_parallel // world_size
             self.prepro = prepro
             self.seed = seed
+            self.param_dtype = param_dtype
+            self.param_delta = param_delta
+            self.stream_interval = stream_interval
+            self.compress = compress
+            self.obs_dtype = obs_dtype
+            self.iteration = 0
+            # tasks up to this iteration are read by all nodes and deleted
+            self.deleted_iteration = 0
 
             self.original_num_parallel = num_parallel
 
+            # triggers left by a previous run would wake nodes up too early
+            self._clear_keys()
+
         self.scatter_from_master('env')
         self.scatter_from_master('pol')
         self.scatter_from_master('num_parallel')
@@ -57,6 +88,10 @@ class DistributedEpiSampler(object):
 
         self.seed = self.seed * (self.rank + 23000)
 
+        # parameters nodes have
+        self.flat_params = flatten(self.pol)
+        self.numels = [p.numel() for p in self.pol.parameters()]
+
         if not rank < 0:
             self.in_node_sampler = EpiSampler(
                 self.env, self.pol, self.num_parallel, self.prepro, self.seed)
@@ -67,88 +102,169 @@ class DistributedEpiSampler(object):
             del self.in_node_sampler
 
     def launch_sampler(self):
+        """
+        Each node samples for the whole budget and streams finished episodes to master
+        until master has enough episodes and stops it.
+        """
+        stop_key = 'stop' + "_{}".format(self.rank)
+        trigger_key = 'task_trigger' + "_{}".format(self.rank)
         while True:
-            self.scatter_from_master('pol')
-            self.scatter_from_master('max_epis')
-            self.scatter_from_master('max_steps')
-            self.scatter_from_master('deterministic')
+            _, value = self.r.blpop(trigger_key)
+            iterations = [int(value)] + self._drain(trigger_key)
+            # parameters are sent as deltas, so tasks of skipped iterations are also decoded in order
+            for iteration in iterations:
+                task = cloudpickle.loads(self.r.get(_task_key(iteration)))
+                decode_params(task['params'], self.flat_params, self.numels)
+            self.r.hset('task_read', self.rank, iterations[-1])
+            unflatten(self.flat_params, self.pol, self.numels)
+            self.task = task
 
-            self.epis = self.in_node_sampler.sample(
-                self.pol, self.max_epis, self.max_steps, self.deterministic)
+            # stops left by iterations this node finished by itself are dropped,
+            # and the task is skipped if it is already stopped
+            if task['iteration'] in self._drain(stop_key):
+                continue
 
-            self.gather_to_master('epis')
+            handle = self.in_node_sampler.sample_async(
+                self.pol, task['max_epis'], task['max_steps'], task['deterministic'])
+            while True:
+                done = handle.done()
+                epis = handle.result() if done else handle.drain()
+                if len(epis) > 0:
+                    self.r.rpush('epis_stream', dumps_epis(
+                        epis, task['compress'], task['obs_dtype'], dict(rank=self.rank, iteration=task['iteration'])))
+                if done:
+                    break
+                value = self.r.blpop(
+                    stop_key, timeout=task['stream_interval'])
+                # stop of an iteration this node finished by itself is ignored
+                if value is not None and int(value[1]) == task['iteration']:
+                    # episodes in progress are abandoned
+                    handle.stop()
+                    break
+
+    def _drain(self, key):
+        """
+        Popping all values of a list at once.
+        """
+        pipe = self.r.pipeline()
+        pipe.lrange(key, 0, -1)
+        pipe.delete(key)
+        values, _ = pipe.execute()
+        return [int(value) for value in values]
+
+    def _clear_keys(self):
+        keys = []
+        for key in SCATTER_KEYS + ('task', ):
+            keys.append(key)
+            keys += [key + '_trigger' +
+                     "_{}".format(rank) for rank in range(self.world_size)]
+        keys += list(self.r.scan_iter(_task_key('*')))
+        keys.append('task_read')
+        for key in GATHER_KEYS:
+            keys.append(key + '_gather')
+        keys.append('epis_stream')
+        keys += ['stop' + "_{}".format(rank)
+                 for rank in range(self.world_size)]
+        self.r.delete(*keys)
 
     def scatter_from_master(self, key):
+        """
+        Master writes obj once and pushes a trigger to each node.
+        Nodes block on their trigger list, so neither side polls.
+        """
 
         if self.rank < 0:
             obj = getattr(self, key)
-            self.r.set(key, cloudpickle.dumps(obj))
-            triggers = {key + '_trigger' +
-                        "_{}".format(rank): '1' for rank in range(self.world_size)}
-            self.r.mset(triggers)
-            while True:
-                time.sleep(0.1)
-                values = self.r.mget(triggers)
-                if all([_int(v) == 0 for v in values]):
-                    break
+            pipe = self.r.pipeline()
+            pipe.set(key, cloudpickle.dumps(obj))
+            for rank in range(self.world_size):
+                pipe.rpush(key + '_trigger' + "_{}".format(rank), '1')
+            pipe.execute()
         else:
-            while True:
-                time.sleep(0.1)
-                trigger = self.r.get(key + '_trigger' +
-                                     "_{}".format(self.rank))
-                if _int(trigger) == 1:
-                    break
+            self.r.blpop(key + '_trigger' + "_{}".format(self.rank))
             obj = cloudpickle.loads(self.r.get(key))
             setattr(self, key, obj)
-            self.r.set(key + '_trigger' + "_{}".format(self.rank), '0')
+
+    def _scatter_task(self):
+        """
+        Master writes the task of each iteration in its own key.
+        A node which lags behind reads tasks of all iterations it skipped.
+        Tasks are deleted after all nodes read them.
+        """
+        read = self.r.hmget('task_read', list(range(self.world_size)))
+        if all([value is not None for value in read]):
+            read = min([int(value) for value in read])
+            if read > self.deleted_iteration:
+                self.r.delete(*[_task_key(iteration) for iteration in range(
+                    self.deleted_iteration + 1, read + 1)])
+                self.deleted_iteration = read
+
+        pipe = self.r.pipeline()
+        pipe.set(_task_key(self.iteration), cloudpickle.dumps(self.task))
+        for rank in range(self.world_size):
+            pipe.rpush('task_trigger' + "_{}".format(rank), self.iteration)
+        pipe.execute()
 
     def gather_to_master(self, key):
         """
         This method assume that obj is summable to list.
+        Nodes push obj to a list and master blocks on it until all nodes push.
         """
 
         if self.rank < 0:
-            num_done = 0
-            objs = []
-            while True:
-                time.sleep(0.1)
-                # This for iteration can be faster.
-                for rank in range(self.world_size):
-                    trigger = self.r.get(key + '_trigger' + "_{}".format(rank))
-                    if _int(trigger) == 1:
-                        obj = cloudpickle.loads(
-                            self.r.get(key + "_{}".format(rank)))
-                        objs += obj
-                        self.r.set(key + '_trigger' + "_{}".format(rank), '0')
-                        num_done += 1
-                if num_done == self.world_size:
-                    break
-            setattr(self, key, objs)
+            objs = dict()
+            while len(objs) < self.world_size:
+                _, value = self.r.blpop(key + '_gather')
+                rank, obj = cloudpickle.loads(value)
+                objs[rank] = obj
+            setattr(self, key, sum([objs[rank]
+                                    for rank in sorted(objs)], []))
         else:
             obj = getattr(self, key)
-            self.r.set(key + "_{}".format(self.rank), cloudpickle.dumps(obj))
-            self.r.set(key + '_trigger' + "_{}".format(self.rank), '1')
-            while True:
-                time.sleep(0.1)
-                if _int(self.r.get(key + '_trigger' + "_{}".format(self.rank))) == 0:
-                    break
+            self.r.rpush(key + '_gather',
+                         cloudpickle.dumps((self.rank, obj)))
 
     def sample(self, pol, max_epis=None, max_steps=None, deterministic=False):
         """
         This method should be called in master node.
+        Episodes are gathered as soon as nodes finish them,
+        and nodes are stopped when max_epis or max_steps is achieved.
         """
-        self.pol = pol
-        self.max_epis = max_epis // self.world_size if max_epis is not None else None
-        self.max_steps = max_steps // self.world_size if max_steps is not None else None
-        self.deterministic = deterministic
+        if max_epis is None and max_steps is None:
+            raise ValueError(
+                'Either max_epis or max_steps needs not to be None')
 
-        self.scatter_from_master('pol')
-        self.scatter_from_master('max_epis')
-        self.scatter_from_master('max_steps')
-        self.scatter_from_master('deterministic')
+        self.iteration += 1
+        self.task = dict(
+            params=encode_params(
+                flatten(pol), self.flat_params, self.numels, self.param_dtype, self.param_delta),
+            max_epis=max_epis,
+            max_steps=max_steps,
+            deterministic=deterministic,
+            iteration=self.iteration,
+            stream_interval=self.stream_interval,
+            compress=self.compress,
+            obs_dtype=self.obs_dtype,
+        )
+        self._scatter_task()
+
+        epis = []
+        num_step = 0
+        while (max_epis is None or len(epis) < max_epis) and (max_steps is None or num_step < max_steps):
+            _, value = self.r.blpop('epis_stream')
+            _epis, meta = loads_epis(value, return_meta=True)
+            if meta['iteration'] != self.iteration:
+                # streamed after the previous iteration was stopped
+                continue
+            epis += _epis
+            num_step += sum([len(epi['rews']) for epi in _epis])
 
-        self.gather_to_master('epis')
+        pipe = self.r.pipeline()
+        for rank in range(self.world_size):
+            pipe.rpush('stop' + "_{}".format(rank), self.iteration)
+        pipe.execute()
 
+        self.epis = epis
         return self.epis
 
 
@@ -0,0 +1,139 @@
+"""
+Shared memory buffer for sending episodes from sampling processes.
+"""
+
+import numpy as np
+import torch
+
+from machina.traj.traj import EPI_KEYS
+
+
+class EpiBuffer(object):
+    """
+    Episodes are written into preallocated columns in shared memory.
+    Columns have the same structure as an episode,
+    dict(obs, acs, rews, dones, a_is=dict, e_is=dict),
+    and episodes are laid contiguously in them.
+    Columns grow if they are short for new episodes.
+    Values of EPI_KEYS are kept in epi_values and sent by pickle.
+
+    Parameters
+    ----------
+    capacity : int
+        Initial number of steps columns can hold.
+    """
+
+    def __init__(self, capacity=1024):
+        self.capacity = capacity
+        self.columns = None
+        self.bounds = []
+        self.epi_values = []
+        self.num_step = 0
+
+    def clear(self):
+        """
+        Forgetting written episodes. Columns are reused.
+        """
+        self.bounds = []
+        self.epi_values = []
+        self.num_step = 0
+
+    def _allocate(self, epi, capacity):
+        columns = dict()
+        for key in epi:
+            if isinstance(epi[key], dict):
+                columns[key] = self._allocate(epi[key], capacity)
+            else:
+                arr = np.asarray(epi[key])
+                columns[key] = torch.zeros((capacity, ) + arr.shape[1:],
+                                           dtype=torch.from_numpy(arr[:0]).dtype).share_memory_()
+        return columns
+
+    def _copy(self, src, dst, length):
+        for key in src:
+            if key not in dst:
+                continue
+            if isinstance(src[key], dict):
+                self._copy(src[key], dst[key], length)
+            else:
+                dst[key][:length] = src[key][:length]
+
+    def _fits(self, epi, columns):
+        for key in epi:
+            if key not in columns:
+                return False
+            if isinstance(epi[key], dict):
+                if not self._fits(epi[key], columns[key]):
+                    return False
+            elif tuple(np.asarray(epi[key]).shape[1:]) != tuple(columns[key].shape[1:]):
+                return False
+        return True
+
+    def _write(self, epi, columns, start, end):
+        for key in epi:
+            if isinstance(epi[key], dict):
+                self._write(epi[key], columns[key], start, end)
+            else:
+                columns[key][start:end] = torch.from_numpy(
+                    np.asarray(epi[key]))
+
+    def append(self, epi):
+        """
+        Writing an episode.
+
+        Parameters
+        ----------
+        epi : dict
+        """
+        epi_values = dict([(key, epi[key]) for key in EPI_KEYS if key in epi])
+        epi = dict([(key, epi[key]) for key in epi if key not in EPI_KEYS])
+        length = len(epi['rews'])
+        end = self.num_step + length
+        if self.columns is None or end > self.capacity or not self._fits(epi, self.columns):
+            capacity = self.capacity
+            while capacity < end:
+                capacity *= 2
+            columns = self._allocate(epi, capacity)
+            if self.columns is not None:
+                self._copy(self.columns, columns, self.num_step)
+            self.columns = columns
+            self.capacity = capacity
+        self._write(epi, self.columns, self.num_step, end)
+        self.bounds.append((self.num_step, end))
+        self.epi_values.append(epi_values)
+        self.num_step = end
+
+
+def _slice_columns(columns, start, end):
+    epi = dict()
+    for key in columns:
+        if isinstance(columns[key], dict):
+            epi[key] = _slice_columns(columns[key], start, end)
+        else:
+            epi[key] = columns[key][start:end].numpy()
+    return epi
+
+
+def epis_from_buffer(columns, bounds, epi_values=None):
+    """
+    Making episodes from columns without copy.
+
+    Parameters
+    ----------
+    columns : dict of torch.Tensor
+        EpiBuffer.columns
+    bounds : list of tuple
+        EpiBuffer.bounds
+    epi_values : list of dict or None
+        EpiBuffer.epi_values
+
+    Returns
+    -------
+    epis : list of dict
+        Each array is a view of columns.
+    """
+    epis = [_slice_columns(columns, start, end) for start, end in bounds]
+    if epi_values is not None:
+        for epi, values in zip(epis, epi_values):
+            epi.update(values)
+    return epis
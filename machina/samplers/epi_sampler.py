@@ -3,14 +3,17 @@ Sampler class
 """
 
 import copy
-import time
 
 import gym
 import numpy as np
 import torch
 import torch.multiprocessing as mp
 
-from machina.utils import cpu_mode
+from machina.prepro import BasePrePro
+from machina.samplers.epi_buffer import EpiBuffer, epis_from_buffer
+from machina.samplers.inference_server import InferenceClient, mp_serve
+from machina.samplers.param_store import ParamStore
+from machina.utils import cpu_mode, get_device
 
 
 LARGE_NUMBER = 100000000
@@ -76,19 +79,245 @@ def one_epi(env, pol, deterministic=False, prepro=None):
             if done:
                 break
             o = next_o
-        return epi_length, dict(
-            obs=np.array(obs, dtype='float32'),
-            acs=np.array(acs, dtype='float32'),
-            rews=np.array(rews, dtype='float32'),
-            dones=np.array(dones, dtype='float32'),
-            a_is=dict([(key, np.array([a_i[key] for a_i in a_is], dtype='float32'))
-                       for key in a_is[0].keys()]),
-            e_is=dict([(key, np.array([e_i[key] for e_i in e_is], dtype='float32'))
-                       for key in e_is[0].keys()])
-        )
-
-
-def mp_sample(pol, env, max_steps, max_epis, n_steps_global, n_epis_global, epis, exec_flag, deterministic_flag, process_id, prepro=None, seed=256):
+        return epi_length, _make_epi(obs, acs, rews, dones, a_is, e_is)
+
+
+def _split_a_i(a_i, num_env, a_i_shape):
+    """
+    Splitting batched agent infos into agent infos of each environment.
+    """
+    _a_i = dict()
+    for key in a_i.keys():
+        if a_i[key] is None:
+            continue
+        if isinstance(a_i[key], tuple):
+            hs = [h.detach().cpu().numpy().reshape(num_env, -1)
+                  for h in a_i[key]]
+            _a_i[key] = [tuple([h[i] for h in hs]) for i in range(num_env)]
+        else:
+            v = a_i[key].detach().cpu().numpy().reshape(
+                (num_env, ) + tuple(a_i_shape))
+            _a_i[key] = [v[i] for i in range(num_env)]
+    return [dict([(key, _a_i[key][i]) for key in _a_i.keys()]) for i in range(num_env)]
+
+
+def _make_epi(obs, acs, rews, dones, a_is, e_is):
+    return dict(
+        obs=np.array(obs, dtype='float32'),
+        acs=np.array(acs, dtype='float32'),
+        rews=np.array(rews, dtype='float32'),
+        dones=np.array(dones, dtype='float32'),
+        a_is=dict([(key, np.array([a_i[key] for a_i in a_is], dtype='float32'))
+                   for key in a_is[0].keys()]),
+        e_is=dict([(key, np.array([e_i[key] for e_i in e_is], dtype='float32'))
+                   for key in e_is[0].keys()])
+    )
+
+
+class EnvRunner(object):
+    """
+    Stepping environments in lockstep one tick at a time.
+    Episodes in progress are kept between calls of step,
+    so sampling can be suspended and resumed at any tick.
+
+    Parameters
+    ----------
+    envs : list of gym.Env
+    pol : Pol
+    prepro : Prepro
+    batch : bool
+        If True, observations of all environments are fed to pol as one batch.
+        If False, there should be only one environment and
+        its observation is fed to pol without batch axis as in one_epi.
+    """
+
+    def __init__(self, envs, pol, prepro=None, batch=True):
+        if prepro is None:
+            def prepro(x): return x
+        self.envs = envs
+        self.pol = pol
+        self.prepro = prepro
+        self.batch = batch or len(envs) > 1
+        self.num_env = len(envs)
+        self.ac_shape = tuple(pol.action_space.shape)
+        self.obs = [None] * self.num_env
+        self.seqs = [None] * self.num_env
+        self.h_masks = np.zeros(self.num_env, dtype='float32')
+        self.reset()
+
+    @property
+    def running(self):
+        return any([seq is not None for seq in self.seqs])
+
+    def reset(self):
+        """
+        Abandoning episodes in progress.
+        """
+        self.seqs = [None] * self.num_env
+        if self.batch:
+            self.pol.reset()
+
+    def _start(self, i):
+        self.obs[i] = self.prepro(self.envs[i].reset())
+        if not self.batch:
+            self.pol.reset()
+        self.seqs[i] = dict(obs=[], acs=[], rews=[],
+                            dones=[], a_is=[], e_is=[])
+        self.h_masks[i] = 1
+
+    def step(self, deterministic=False, start=None, segment=False):
+        """
+        Stepping all running environments once.
+
+        Parameters
+        ----------
+        deterministic : bool
+            If True, policy is deterministic.
+        start : function or None
+            Called before an idle environment starts a new episode.
+            The episode starts only if it returns True.
+            If None, episodes always start.
+        segment : bool
+            If True, finished episodes have truncated and last_ob as segments of cut.
+
+        Returns
+        -------
+        epis : list of dict
+            Episodes finished at this tick.
+        """
+        with cpu_mode():
+            for i in range(self.num_env):
+                if self.seqs[i] is None and (start is None or start()):
+                    self._start(i)
+            if not self.running:
+                return []
+
+            num_env = self.num_env
+            pol = self.pol
+            kwargs = dict()
+            if self.batch:
+                # finished environments keep their last observation to fill the batch
+                # and environments which have never started are filled with zeros
+                started = [ob for ob in self.obs if ob is not None]
+                if len(started) < num_env:
+                    zero_ob = np.zeros_like(np.asarray(started[0]))
+                    self.obs = [
+                        zero_ob if ob is None else ob for ob in self.obs]
+                o = torch.tensor(np.array(self.obs), dtype=torch.float)
+                if pol.rnn:
+                    kwargs['h_masks'] = torch.tensor(
+                        self.h_masks).reshape(1, num_env, 1)
+            else:
+                o = torch.tensor(self.obs[0], dtype=torch.float)
+            if not deterministic:
+                ac_real, ac, a_i = pol(o, **kwargs)
+            else:
+                ac_real, ac, a_i = pol.deterministic_ac_real(o, **kwargs)
+            self.h_masks[:] = 0
+            ac_real = np.array(ac_real).reshape((num_env, ) + self.ac_shape)
+            ac = ac.detach().cpu().numpy().reshape((num_env, ) + self.ac_shape)
+            a_is = _split_a_i(a_i, num_env, pol.a_i_shape)
+
+            epis = []
+            for i in range(num_env):
+                seq = self.seqs[i]
+                if seq is None:
+                    continue
+                next_o, r, done, e_i = self.envs[i].step(
+                    np.array(ac_real[i]))
+                seq['obs'].append(self.obs[i])
+                seq['acs'].append(ac[i])
+                seq['rews'].append(r)
+                seq['dones'].append(done)
+                seq['a_is'].append(a_is[i])
+                seq['e_is'].append(e_i)
+                if done:
+                    epi = _make_epi(**seq)
+                    if segment:
+                        epi['truncated'] = False
+                        epi['last_ob'] = np.array(
+                            self.prepro(next_o), dtype='float32')
+                    epis.append(epi)
+                    self.seqs[i] = None
+                else:
+                    self.obs[i] = self.prepro(next_o)
+            return epis
+
+    def cut(self):
+        """
+        Cutting episodes in progress into segments.
+        The episodes go on and following steps make next segments.
+
+        Returns
+        -------
+        segments : list of dict
+            Episodes with truncated=True and last_ob,
+            an observation following the last step for bootstrapping.
+        """
+        segments = []
+        for i in range(self.num_env):
+            seq = self.seqs[i]
+            if seq is None or len(seq['rews']) == 0:
+                continue
+            segment = _make_epi(**seq)
+            segment['truncated'] = True
+            segment['last_ob'] = np.array(self.obs[i], dtype='float32')
+            segments.append(segment)
+            self.seqs[i] = dict(obs=[], acs=[], rews=[],
+                                dones=[], a_is=[], e_is=[])
+        return segments
+
+
+def vec_epis(envs, pol, max_steps, max_epis, n_steps_global, n_epis_global, deterministic=False, prepro=None):
+    """
+    Sampling episodes from several environments in lockstep.
+    Observations of all environments are fed to the policy as one batch.
+    An environment starts a new episode only while max_steps and max_epis are not achieved.
+
+    Parameters
+    ----------
+    envs : list of gym.Env
+    pol : Pol
+        Pol should accept a batch of observations.
+    max_steps : int
+        maximum steps of episodes
+    max_epis : int
+        maximum episodes of episodes
+    n_steps_global : torch.Tensor
+        shared Tensor
+    n_epis_global : torch.Tensor
+        shared Tensor
+    deterministic : bool
+        If True, policy is deterministic.
+    prepro : Prepro
+
+    Returns
+    -------
+    epis : list of dict
+    """
+    runner = EnvRunner(envs, pol, prepro)
+
+    def remaining():
+        return bool(max_steps > n_steps_global and max_epis > n_epis_global)
+
+    def start():
+        # episodes are counted when they start so that lockstep environments do not exceed max_epis
+        if remaining():
+            n_epis_global.add_(1)
+            return True
+        return False
+
+    epis = []
+    while True:
+        for epi in runner.step(deterministic, start):
+            n_steps_global += len(epi['rews'])
+            epis.append(epi)
+        if not runner.running and not remaining():
+            break
+    return epis
+
+
+def mp_sample(pol, param_store, env, max_steps, max_epis, n_steps_global, n_epis_global, conn, process_id, prepro=None, seed=256, num_env=1, client=None):
     """
     Multiprocess sample.
     Sampling episodes until max_steps or max_epis is achieved.
@@ -96,38 +325,217 @@ def mp_sample(pol, env, max_steps, max_epis, n_steps_global, n_epis_global, epis
     Parameters
     ----------
     pol : Pol
+        This process uses a copy of pol.
+    param_store : ParamStore
+        Parameters of pol are pulled from it when they are updated.
     env : gym.Env
-    max_steps : int
+    max_steps : torch.Tensor
         maximum steps of episodes
-    max_epis : int
+    max_epis : torch.Tensor
         maximum episodes of episodes
     n_steps_global : torch.Tensor
         shared Tensor
     n_epis_global : torch.Tensor
         shared Tensor
-    epis : list
-        multiprocessing's list for sharing episodes between processes.
-    exec_flag : torch.Tensor
-        execution flag
-    deterministic_flag : torch.Tensor
+    conn : multiprocessing.connection.Connection
+        Commands are received from conn.
+        ('epis', deterministic) samples episodes until max_steps or max_epis is achieved.
+        ('actor', deterministic) samples episodes until ('stop', ) is received.
+        ('steps', num_tick, deterministic) steps environments num_tick times
+        and sends segments. Episodes in progress continue at the next ('steps', ...).
+        While sampling, ('drain', ) makes finished episodes sent without stopping.
+        Episodes are sent as (columns, bounds, epi_values, final) of EpiBuffer.
     process_id : int
     prepro : Prepro
     seed : int
+    num_env : int
+        Number of environments stepped in lockstep in this process.
+        If num_env > 1, copies of env are made and pol is computed in batch.
+    client : InferenceClient or None
+        If not None, actions are computed by the inference server instead of pol.
     """
 
     np.random.seed(seed + process_id)
     torch.manual_seed(seed + process_id)
     torch.set_num_threads(1)
 
+    if num_env > 1:
+        envs = [copy.deepcopy(env) for _ in range(num_env)]
+        for i, e in enumerate(envs):
+            e = getattr(e, 'unwrapped', e)
+            if hasattr(e, 'seed'):
+                e.seed(seed + process_id * num_env + i)
+    else:
+        envs = [env]
+    if client is not None:
+        pol = client
+    else:
+        pol = copy.deepcopy(pol)
+    version = -1
+
+    runner = EnvRunner(envs, pol, prepro,
+                       batch=num_env > 1 or client is not None)
+    # episodes are written to one buffer while the other is read by the master
+    epi_buffers = [EpiBuffer(), EpiBuffer()]
+    last_mode = None
+
     while True:
-        time.sleep(0.1)
-        if exec_flag > 0:
-            while max_steps > n_steps_global and max_epis > n_epis_global:
-                l, epi = one_epi(env, pol, deterministic_flag, prepro)
-                n_steps_global += l
-                n_epis_global += 1
-                epis.append(epi)
-            exec_flag.zero_()
+        command = conn.recv()
+        if command[0] not in ('epis', 'actor', 'steps'):
+            # drain or stop arrived after sampling finished
+            continue
+        mode = command[0]
+        if mode == 'steps':
+            _, num_tick, deterministic = command
+        else:
+            _, deterministic = command
+
+        def remaining():
+            return bool(max_steps > n_steps_global and max_epis > n_epis_global)
+
+        def start():
+            if mode != 'epis':
+                return True
+            # episodes are counted when they start so that lockstep environments do not exceed max_epis
+            if remaining():
+                n_epis_global.add_(1)
+                return True
+            return False
+
+        epi_buffer = epi_buffers[0]
+        epi_buffer.clear()
+        if mode != 'steps' or last_mode != 'steps':
+            runner.reset()
+        last_mode = mode
+        tick = 0
+        while True:
+            if conn.poll():
+                command = conn.recv()
+                if command[0] == 'stop':
+                    break
+                elif command[0] == 'drain':
+                    conn.send((epi_buffer.columns, epi_buffer.bounds,
+                               epi_buffer.epi_values, False))
+                    epi_buffers.reverse()
+                    epi_buffer = epi_buffers[0]
+                    epi_buffer.clear()
+            if client is None:
+                version = param_store.pull(pol, version)
+            for epi in runner.step(deterministic, start, mode == 'steps'):
+                n_steps_global += len(epi['rews'])
+                epi_buffer.append(epi)
+            tick += 1
+            if mode == 'steps':
+                if tick >= num_tick:
+                    for segment in runner.cut():
+                        epi_buffer.append(segment)
+                    break
+            elif not runner.running and not remaining():
+                break
+        conn.send((epi_buffer.columns, epi_buffer.bounds,
+                   epi_buffer.epi_values, True))
+
+
+class SampleHandle(object):
+    """
+    Handle of sampling running in background.
+    It is returned by EpiSampler.sample_async and EpiSampler.start_actor.
+
+    Parameters
+    ----------
+    conns : list of multiprocessing.connection.Connection
+    max_epis : int or None
+        If not None, returned episodes are cut at max_epis in total,
+        because processes may start episodes at the same time.
+    """
+
+    def __init__(self, conns, max_epis=None):
+        self.conns = conns
+        self.finished = [False] * len(conns)
+        self.epis = [[] for _ in conns]
+        self.max_epis = max_epis
+        self.n_epis = 0
+
+    def _recv(self, i):
+        columns, bounds, epi_values, final = self.conns[i].recv()
+        if final:
+            self.finished[i] = True
+        self.epis[i] += epis_from_buffer(columns, bounds, epi_values)
+
+    def _pop(self):
+        epis = []
+        for i in range(len(self.epis)):
+            epis += self.epis[i]
+            self.epis[i] = []
+        if self.max_epis is not None:
+            epis = epis[:max(self.max_epis - self.n_epis, 0)]
+        self.n_epis += len(epis)
+        return epis
+
+    def done(self):
+        """
+        Checking whether all processes finished sampling without blocking.
+
+        Returns
+        -------
+        done : bool
+        """
+        for i, conn in enumerate(self.conns):
+            if not self.finished[i] and conn.poll():
+                self._recv(i)
+        return all(self.finished)
+
+    def result(self):
+        """
+        Waiting until all processes finish sampling.
+        In actor mode, this blocks until stop is called.
+
+        Returns
+        -------
+        epis : list of dict
+            Episodes which are not returned yet.
+            Arrays are views of shared memory and they are overwritten
+            at the next call of the sampler. Copy them if they are kept.
+        """
+        for i in range(len(self.conns)):
+            while not self.finished[i]:
+                self._recv(i)
+        return self._pop()
+
+    def drain(self):
+        """
+        Taking finished episodes without stopping sampling.
+
+        Returns
+        -------
+        epis : list of dict
+            Episodes finished since the last drain.
+            Arrays are views of shared memory and they are overwritten
+            at the next drain. Copy them if they are kept.
+        """
+        sent = []
+        for i, conn in enumerate(self.conns):
+            if not self.finished[i]:
+                conn.send(('drain', ))
+                sent.append(i)
+        # exactly one reply comes for each drain even if the process finishes meanwhile
+        for i in sent:
+            self._recv(i)
+        return self._pop()
+
+    def stop(self):
+        """
+        Stopping sampling. Episodes in progress are abandoned.
+
+        Returns
+        -------
+        epis : list of dict
+            Episodes which are not returned yet.
+        """
+        for i, conn in enumerate(self.conns):
+            if not self.finished[i]:
+                conn.send(('stop', ))
+        return self.result()
 
 
 class EpiSampler(object):
@@ -141,16 +549,41 @@ class EpiSampler(object):
     num_parallel : int
         Number of processes
     prepro : Prepro
+        BasePrePro or its bound method such as prepro_with_update.
+        Statistics of BasePrePro are moved to shared memory,
+        so all processes update the same statistics.
     seed : int
+    num_env_per_process : int
+        Number of environments each process steps in lockstep.
+        Policy is computed for their observations in one batch,
+        so pol should accept a batch of observations.
+    inference_server : bool
+        If True, processes only step environments and
+        one more process computes pol for observations of all processes in batch.
+        The server computes on the device given by machina.utils.set_device.
+        If it is cuda, the start method of multiprocessing should be spawn.
+    max_batch_size : int or None
+        Maximum number of observations the server computes at once.
+        If None, observations of all processes are batched.
+    max_wait : float
+        Maximum seconds the server waits for other processes
+        after the first observation arrives.
     """
 
-    def __init__(self, env, pol, num_parallel=8, prepro=None, seed=256):
+    def __init__(self, env, pol, num_parallel=8, prepro=None, seed=256, num_env_per_process=1,
+                 inference_server=False, max_batch_size=None, max_wait=0.001):
         self.env = env
         self.pol = copy.deepcopy(pol)
         self.pol.to('cpu')
-        self.pol.share_memory()
         self.pol.eval()
+        self.param_store = ParamStore(self.pol)
         self.num_parallel = num_parallel
+        self.num_env_per_process = num_env_per_process
+
+        if isinstance(prepro, BasePrePro):
+            prepro = prepro.prepro_with_update
+        if isinstance(getattr(prepro, '__self__', None), BasePrePro):
+            prepro.__self__.share_memory()
 
         self.n_steps_global = torch.tensor(0, dtype=torch.long).share_memory_()
         self.max_steps = torch.tensor(0, dtype=torch.long).share_memory_()
@@ -158,26 +591,58 @@ class EpiSampler(object):
             0, dtype=torch.long).share_memory_()
         self.max_epis = torch.tensor(0, dtype=torch.long).share_memory_()
 
-        self.exec_flags = [torch.tensor(
-            0, dtype=torch.long).share_memory_() for _ in range(self.num_parallel)]
-        self.deterministic_flag = torch.tensor(
-            0, dtype=torch.uint8).share_memory_()
+        self.conns = [mp.Pipe() for _ in range(self.num_parallel)]
 
-        self.epis = mp.Manager().list()
         self.processes = []
+
+        clients = [None] * self.num_parallel
+        if inference_server:
+            ob_buf = torch.zeros((self.num_parallel, num_env_per_process) + tuple(
+                env.observation_space.shape), dtype=torch.float).share_memory_()
+            h_mask_buf = torch.zeros(
+                (self.num_parallel, num_env_per_process), dtype=torch.float).share_memory_()
+            request_queue = mp.Queue()
+            conns = [mp.Pipe(duplex=False) for _ in range(self.num_parallel)]
+            clients = [InferenceClient(self.pol, ind, ob_buf, h_mask_buf, request_queue, conns[ind][0])
+                       for ind in range(self.num_parallel)]
+            if max_batch_size is None:
+                max_batch_size = self.num_parallel * num_env_per_process
+            p = mp.Process(target=mp_serve, args=(self.pol, self.param_store, ob_buf, h_mask_buf, request_queue, [
+                           conn[1] for conn in conns], max_batch_size, max_wait, get_device()))
+            p.start()
+            self.processes.append(p)
+
         for ind in range(self.num_parallel):
-            p = mp.Process(target=mp_sample, args=(self.pol, env, self.max_steps, self.max_epis, self.n_steps_global,
-                                                   self.n_epis_global, self.epis, self.exec_flags[ind], self.deterministic_flag, ind, prepro, seed))
+            p = mp.Process(target=mp_sample, args=(self.pol, self.param_store, env, self.max_steps, self.max_epis, self.n_steps_global,
+                                                   self.n_epis_global, self.conns[ind][1], ind, prepro, seed, num_env_per_process, clients[ind]))
             p.start()
             self.processes.append(p)
+        self.conns = [conn[0] for conn in self.conns]
+        self.handle = None
 
     def __del__(self):
         for p in self.processes:
             p.terminate()
 
-    def sample(self, pol, max_epis=None, max_steps=None, deterministic=False):
+    def publish(self, pol):
         """
-        Switch on sampling processes.
+        Copying parameters of pol to processes.
+        Processes sampling in background use them from the next step.
+
+        Parameters
+        ----------
+        pol : Pol
+        """
+        self.param_store.publish(pol)
+
+    def _check_handle(self):
+        if self.handle is not None and not self.handle.done():
+            raise RuntimeError(
+                'Previous sampling is still running. Call result or stop of its handle.')
+
+    def sample_async(self, pol, max_epis=None, max_steps=None, deterministic=False):
+        """
+        Switch on sampling processes without waiting for them.
 
         Parameters
         ----------
@@ -192,20 +657,22 @@ class EpiSampler(object):
 
         Returns
         -------
-        epis : list of dict
-            Sampled epis.
+        handle : SampleHandle
+            Sampled epis are obtained by handle.result().
 
         Raises
         ------
         ValueError
             If max_steps and max_epis are botch None.
+        RuntimeError
+            If previous sampling is still running.
         """
-        for sp, p in zip(self.pol.parameters(), pol.parameters()):
-            sp.data.copy_(p.data.to('cpu'))
-
         if max_epis is None and max_steps is None:
             raise ValueError(
                 'Either max_epis or max_steps needs not to be None')
+        self._check_handle()
+        self.publish(pol)
+
         max_epis = max_epis if max_epis is not None else LARGE_NUMBER
         max_steps = max_steps if max_steps is not None else LARGE_NUMBER
 
@@ -217,17 +684,108 @@ class EpiSampler(object):
         self.max_epis.zero_()
         self.max_epis += max_epis
 
-        if deterministic:
-            self.deterministic_flag.zero_()
-            self.deterministic_flag += 1
-        else:
-            self.deterministic_flag.zero_()
+        for conn in self.conns:
+            conn.send(('epis', deterministic))
+        self.handle = SampleHandle(self.conns, max_epis)
+        return self.handle
 
-        del self.epis[:]
+    def start_actor(self, pol, deterministic=False):
+        """
+        Switch on sampling processes which keep sampling until stopped.
+        Episodes are taken by handle.drain() whenever they are needed,
+        and parameters used by processes are updated by publish.
 
-        for exec_flag in self.exec_flags:
-            exec_flag += 1
+        Parameters
+        ----------
+        pol : Pol
+        deterministic : bool
 
-        while True:
-            if all([exec_flag == 0 for exec_flag in self.exec_flags]):
-                return list(self.epis)
+        Returns
+        -------
+        handle : SampleHandle
+
+        Raises
+        ------
+        RuntimeError
+            If previous sampling is still running.
+        """
+        self._check_handle()
+        self.publish(pol)
+
+        self.n_steps_global.zero_()
+        self.n_epis_global.zero_()
+
+        for conn in self.conns:
+            conn.send(('actor', deterministic))
+        self.handle = SampleHandle(self.conns)
+        return self.handle
+
+    def sample(self, pol, max_epis=None, max_steps=None, deterministic=False):
+        """
+        Switch on sampling processes.
+
+        Parameters
+        ----------
+        pol : Pol
+        max_epis : int or None
+            maximum episodes of episodes.
+            If None, this value is ignored.
+        max_steps : int or None
+            maximum steps of episodes
+            If None, this value is ignored.
+        deterministic : bool
+
+        Returns
+        -------
+        epis : list of dict
+            Sampled epis.
+            Arrays are views of shared memory and they are overwritten
+            at the next call of sample. Copy them if they are kept.
+
+        Raises
+        ------
+        ValueError
+            If max_steps and max_epis are botch None.
+        """
+        return self.sample_async(pol, max_epis, max_steps, deterministic).result()
+
+    def sample_steps(self, pol, n_steps_per_worker, deterministic=False):
+        """
+        Sampling fixed length segments.
+        Each process steps its environments for n_steps_per_worker steps in total.
+        Environments are not reset between calls, and
+        episodes in progress are returned as truncated segments
+        which continue at the next call.
+
+        Parameters
+        ----------
+        pol : Pol
+        n_steps_per_worker : int
+            Steps of each process. It is divided by num_env_per_process.
+        deterministic : bool
+
+        Returns
+        -------
+        epis : list of dict
+            Finished episodes and truncated segments.
+            Each of them has truncated (bool) and last_ob,
+            an observation following the last step for bootstrapping.
+            Arrays are views of shared memory and they are overwritten
+            at the next call of the sampler. Copy them if they are kept.
+
+        Raises
+        ------
+        RuntimeError
+            If previous sampling is still running.
+        """
+        self._check_handle()
+        self.publish(pol)
+
+        self.n_steps_global.zero_()
+        self.n_epis_global.zero_()
+
+        num_tick = max(1, n_steps_per_worker // self.num_env_per_process)
+        for conn in self.conns:
+            conn.send(('steps', num_tick, deterministic))
+        self.handle = SampleHandle(self.conns)
+        return self.handle.result()
@@ -0,0 +1,185 @@
+"""
+Inference server for EpiSampler.
+Sampling processes only step environments, and one process computes the policy for all of them in batch.
+"""
+
+import copy
+import queue
+import time
+
+import numpy as np
+import torch
+
+
+class InferenceClient(object):
+    """
+    Stand-in for a policy inside a sampling process.
+    Observations are written to shared memory and
+    actions are computed by the inference server.
+
+    Parameters
+    ----------
+    pol : Pol
+        Only attributes describing spaces are used.
+    process_id : int
+    ob_buf : torch.Tensor
+        shared Tensor of observations. shape is (num_parallel, num_env, *observation_space.shape)
+    h_mask_buf : torch.Tensor
+        shared Tensor of masks for hidden states. shape is (num_parallel, num_env)
+    request_queue : multiprocessing.Queue
+    conn : multiprocessing.connection.Connection
+        Connection actions are received from.
+    """
+
+    def __init__(self, pol, process_id, ob_buf, h_mask_buf, request_queue, conn):
+        self.observation_space = pol.observation_space
+        self.action_space = pol.action_space
+        self.a_i_shape = pol.a_i_shape
+        self.rnn = pol.rnn
+        self.process_id = process_id
+        self.ob_buf = ob_buf
+        self.h_mask_buf = h_mask_buf
+        self.request_queue = request_queue
+        self.conn = conn
+
+    def reset(self):
+        """
+        Hidden states are held in the server and reset by h_masks.
+        """
+        pass
+
+    def _request(self, obs, h_masks, deterministic):
+        self.ob_buf[self.process_id].copy_(
+            obs.reshape(self.ob_buf[self.process_id].shape))
+        if h_masks is not None:
+            self.h_mask_buf[self.process_id].copy_(h_masks.reshape(-1))
+        self.request_queue.put((self.process_id, bool(deterministic)))
+        ac_real, ac, a_i = self.conn.recv()
+        ac = torch.tensor(ac)
+        _a_i = dict()
+        for key in a_i:
+            if isinstance(a_i[key], tuple):
+                _a_i[key] = tuple([torch.tensor(h) for h in a_i[key]])
+            else:
+                _a_i[key] = torch.tensor(a_i[key])
+        return ac_real, ac, _a_i
+
+    def __call__(self, obs, h_masks=None):
+        return self._request(obs, h_masks, False)
+
+    def deterministic_ac_real(self, obs, h_masks=None):
+        return self._request(obs, h_masks, True)
+
+
+def _to_numpy(a_i):
+    _a_i = dict()
+    for key in a_i:
+        if a_i[key] is None:
+            continue
+        if isinstance(a_i[key], tuple):
+            _a_i[key] = tuple([h.detach().cpu().numpy() for h in a_i[key]])
+        else:
+            _a_i[key] = a_i[key].detach().cpu().numpy()
+    return _a_i
+
+
+def _slice_a_i(a_i, start, end, rnn):
+    # outputs of rnn have time axis at first
+    _a_i = dict()
+    for key in a_i:
+        if isinstance(a_i[key], tuple):
+            _a_i[key] = tuple([h[start:end] for h in a_i[key]])
+        elif rnn:
+            _a_i[key] = a_i[key][:, start:end]
+        else:
+            _a_i[key] = a_i[key][start:end]
+    return _a_i
+
+
+def mp_serve(pol, param_store, ob_buf, h_mask_buf, request_queue, conns, max_batch_size, max_wait, device='cpu'):
+    """
+    Inference server.
+    Gathering requests from sampling processes, computing policy in batch and scattering actions.
+
+    Parameters
+    ----------
+    pol : Pol
+    param_store : ParamStore
+        Parameters of pol are pulled from it when they are updated.
+    ob_buf : torch.Tensor
+        shared Tensor of observations.
+    h_mask_buf : torch.Tensor
+        shared Tensor of masks for hidden states.
+    request_queue : multiprocessing.Queue
+    conns : list of multiprocessing.connection.Connection
+        Connections actions are sent to. Index is process_id.
+    max_batch_size : int
+        Maximum number of observations computed in one batch.
+    max_wait : float
+        Maximum seconds waiting for other requests after the first request arrives.
+    device : str or torch.device
+    """
+    torch.set_num_threads(1)
+
+    num_env = ob_buf.size(1)
+    ob_shape = ob_buf.shape[2:]
+    device = torch.device(device)
+    server_pol = copy.deepcopy(pol).to(device)
+    server_pol.eval()
+    version = -1
+
+    hs = None
+    if server_pol.rnn:
+        hs = server_pol.net.init_hs(ob_buf.size(0) * num_env)
+
+    while True:
+        requests = [request_queue.get()]
+        deadline = time.time() + max_wait
+        while len(requests) * num_env < max_batch_size:
+            timeout = deadline - time.time()
+            if timeout <= 0:
+                break
+            try:
+                requests.append(request_queue.get(timeout=timeout))
+            except queue.Empty:
+                break
+
+        version = param_store.pull(server_pol, version)
+
+        for deterministic in (False, True):
+            process_ids = [pid for pid,
+                           d in requests if bool(d) == deterministic]
+            if len(process_ids) == 0:
+                continue
+            obs = ob_buf[process_ids].reshape(
+                (len(process_ids) * num_env, ) + ob_shape).to(device)
+            kwargs = dict()
+            if server_pol.rnn:
+                slots = torch.cat([torch.arange(pid * num_env, (pid + 1) * num_env)
+                                   for pid in process_ids])
+                if isinstance(hs, tuple):
+                    kwargs['hs'] = tuple([h[slots] for h in hs])
+                else:
+                    kwargs['hs'] = hs[slots]
+                kwargs['h_masks'] = h_mask_buf[process_ids].reshape(
+                    1, len(process_ids) * num_env, 1).to(device)
+            with torch.no_grad():
+                if not deterministic:
+                    ac_real, ac, a_i = server_pol(obs, **kwargs)
+                else:
+                    ac_real, ac, a_i = server_pol.deterministic_ac_real(
+                        obs, **kwargs)
+            if server_pol.rnn:
+                if isinstance(hs, tuple):
+                    for h, new_h in zip(hs, server_pol.hs):
+                        h[slots] = new_h.reshape(h[slots].shape)
+                else:
+                    hs[slots] = server_pol.hs.reshape(hs[slots].shape)
+            ac_real = np.array(ac_real).reshape(
+                (len(process_ids), num_env) + tuple(server_pol.action_space.shape))
+            ac = ac.detach().cpu().numpy().reshape(
+                (len(process_ids), num_env) + tuple(server_pol.action_space.shape))
+            a_i = _to_numpy(a_i)
+            for i, pid in enumerate(process_ids):
+                conns[pid].send((ac_real[i], ac[i], _slice_a_i(
+                    a_i, i * num_env, (i + 1) * num_env, server_pol.rnn)))
@@ -0,0 +1,168 @@
+"""
+Versioned store of policy parameters shared with sampling processes.
+"""
+
+import numpy as np
+import torch
+
+
+class ParamStore(object):
+    """
+    Parameters of a module are flattened into one shared Tensor with a version counter.
+    The learner publishes parameters with a single copy, and
+    processes pull them into their own copy of the module only when the version changes.
+    The version is odd while parameters are written,
+    so readers retry instead of taking a lock.
+
+    Parameters
+    ----------
+    module : torch.nn.Module
+        Template of modules whose parameters are stored.
+    """
+
+    def __init__(self, module):
+        self.numels = [p.numel() for p in module.parameters()]
+        self.flat = torch.zeros(sum(self.numels)).share_memory_()
+        self.version = torch.tensor(0, dtype=torch.long).share_memory_()
+        self.publish(module)
+
+    def publish(self, module):
+        """
+        Writing parameters of module.
+
+        Parameters
+        ----------
+        module : torch.nn.Module
+        """
+        params = [p.data.reshape(-1) for p in module.parameters()]
+        self.version += 1
+        if len(params) > 0:
+            self.flat.copy_(torch.cat(params))
+        self.version += 1
+
+    def pull(self, module, version=-1):
+        """
+        Reading parameters into module if they are newer than version.
+
+        Parameters
+        ----------
+        module : torch.nn.Module
+        version : int
+            Version module has.
+
+        Returns
+        -------
+        version : int
+            Version module has after pulling.
+        """
+        while True:
+            new_version = int(self.version)
+            if new_version == version:
+                return version
+            if new_version % 2 == 1:
+                continue
+            flat = self.flat.clone()
+            if int(self.version) == new_version:
+                break
+        unflatten(flat, module, self.numels)
+        return new_version
+
+
+def flatten(module):
+    """
+    Flattening parameters of module into one Tensor on cpu.
+
+    Parameters
+    ----------
+    module : torch.nn.Module
+
+    Returns
+    -------
+    flat : torch.Tensor
+    """
+    params = [p.data.reshape(-1) for p in module.parameters()]
+    if len(params) == 0:
+        return torch.zeros(0)
+    return torch.cat(params).to('cpu')
+
+
+def unflatten(flat, module, numels=None):
+    """
+    Copying flattened parameters into module.
+
+    Parameters
+    ----------
+    flat : torch.Tensor
+    module : torch.nn.Module
+    numels : list of int or None
+        Number of elements of each parameter.
+    """
+    params = list(module.parameters())
+    if numels is None:
+        numels = [p.numel() for p in params]
+    if len(params) == 0:
+        return
+    device = params[0].device
+    for p, v in zip(params, flat.to(device).split(numels)):
+        p.data.copy_(v.view_as(p))
+
+
+def encode_params(flat, ref, numels, dtype='float32', delta=False):
+    """
+    Encoding flattened parameters to send them to other nodes.
+
+    Parameters
+    ----------
+    flat : torch.Tensor
+        Flattened parameters to send.
+    ref : torch.Tensor
+        Flattened parameters the receiver has. It is updated to what the receiver has after decoding.
+    numels : list of int
+        Number of elements of each parameter.
+    dtype : str
+        'float32' or 'float16'.
+    delta : bool
+        If True, only parameters which differ from ref are sent.
+
+    Returns
+    -------
+    payload : tuple
+        (indices of sent parameters, dtype, raw bytes)
+    """
+    torch_dtype = torch.float16 if dtype == 'float16' else torch.float32
+    quantized = flat.to(torch_dtype).float()
+    indices = []
+    chunks = []
+    for i, (q, r) in enumerate(zip(quantized.split(numels), ref.split(numels))):
+        if delta and torch.equal(q, r):
+            continue
+        indices.append(i)
+        chunks.append(q)
+        r.copy_(q)
+    if len(chunks) > 0:
+        data = torch.cat(chunks).to(torch_dtype).numpy().tobytes()
+    else:
+        data = b''
+    return indices, dtype, data
+
+
+def decode_params(payload, ref, numels):
+    """
+    Decoding parameters encoded by encode_params.
+
+    Parameters
+    ----------
+    payload : tuple
+    ref : torch.Tensor
+        Flattened parameters. Sent parameters are written into it.
+    numels : list of int
+        Number of elements of each parameter.
+    """
+    indices, dtype, data = payload
+    values = torch.from_numpy(np.frombuffer(
+        data, dtype=dtype).astype('float32'))
+    params = ref.split(numels)
+    start = 0
+    for i in indices:
+        params[i].copy_(values[start:start + numels[i]])
+        start += numels[i]
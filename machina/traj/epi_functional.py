@@ -9,12 +9,46 @@ import torch.nn.functional as F
 
 from machina.utils import get_device
 from machina import loss_functional as lf
+from machina.prepro import RunningMeanStd
 from machina.traj import Traj
 
+# maximum number of steps computed in one forward of batched functions
+FORWARD_BATCH_SIZE = 65536
+
+
+def _cat_epis(arrays):
+    return torch.as_tensor(np.concatenate(arrays, axis=0), dtype=torch.float, device=get_device())
+
+
+def _split_epis(values, lengths):
+    return np.split(values, np.cumsum(lengths)[:-1], axis=0)
+
+
+def _pad_epis(arrays):
+    # (max_length, num_epi, *) padded with zeros
+    lengths = [len(arr) for arr in arrays]
+    padded = np.zeros((max(lengths), len(arrays)) +
+                      np.shape(arrays[0])[1:], dtype=np.float32)
+    for i, arr in enumerate(arrays):
+        padded[:len(arr), i] = arr
+    return torch.as_tensor(padded, device=get_device()), lengths
+
+
+def _forward_in_chunks(func, *inputs):
+    """
+    Applying func to inputs concatenated over episodes.
+    Inputs are split into chunks of FORWARD_BATCH_SIZE steps,
+    and outputs of chunks are concatenated.
+    """
+    outputs = [func(*[x[start:start + FORWARD_BATCH_SIZE] for x in inputs])
+               for start in range(0, len(inputs[0]), FORWARD_BATCH_SIZE)]
+    return torch.cat(outputs, dim=0)
+
 
 def compute_vs(data, vf):
     """
     Computing Value Function.
+    For truncated segments, value of last_ob is also computed as last_v.
 
     Parameters
     ----------
@@ -31,16 +65,36 @@ def compute_vs(data, vf):
     else:
         epis = data
 
+    if len(epis) == 0:
+        return data
+
+    obs = []
+    for epi in epis:
+        if epi.get('truncated', False):
+            obs.append(np.concatenate(
+                [epi['obs'], epi['last_ob'][None]], axis=0))
+        else:
+            obs.append(epi['obs'])
+
     vf.reset()
     with torch.no_grad():
-        for epi in epis:
-            if vf.rnn:
-                obs = torch.tensor(
-                    epi['obs'], dtype=torch.float, device=get_device()).unsqueeze(1)
-            else:
-                obs = torch.tensor(
-                    epi['obs'], dtype=torch.float, device=get_device())
-            epi['vs'] = vf(obs)[0].detach().cpu().numpy()
+        if vf.rnn:
+            # episodes are computed in parallel from initial hidden states
+            padded_obs, lengths = _pad_epis(obs)
+            vs = vf(padded_obs)[0].cpu().numpy()
+            epi_vs = [vs[:length, i:i+1] for i, length in enumerate(lengths)]
+        else:
+            vs = _forward_in_chunks(
+                lambda o: vf(o)[0], _cat_epis(obs)).cpu().numpy()
+            epi_vs = _split_epis(vs, [len(o) for o in obs])
+    vf.reset()
+
+    for epi, vs in zip(epis, epi_vs):
+        if epi.get('truncated', False):
+            epi['vs'] = vs[:-1]
+            epi['last_v'] = vs[-1]
+        else:
+            epi['vs'] = vs
 
     return data
 
@@ -99,30 +153,89 @@ def compute_pris(data, qf, targ_qf, pol, gamma, continuous=True, deterministic=T
             epis = data.current_epis
         else:
             epis = data
+        if len(epis) == 0:
+            return data
+        columns = dict()
+        for key in ['obs', 'acs', 'rews', 'dones']:
+            columns[key] = [epi[key] for epi in epis]
+        columns['next_obs'] = []
         for epi in epis:
-            data_map = dict()
-            keys = ['obs', 'acs', 'rews', 'next_obs', 'dones']
-            for key in keys:
-                data_map[key] = torch.tensor(epi[key], device=get_device())
+            if 'next_obs' in epi:
+                columns['next_obs'].append(epi['next_obs'])
+            else:
+                # Traj with lazy_next_obs does not have next_obs in epis
+                obs = np.asarray(epi['obs'])
+                columns['next_obs'].append(
+                    np.concatenate([obs[1:], obs[:1]], axis=0))
+
+        def _pris(data_map):
+            bellman_loss = lf.bellman(
+                qf, targ_qf, pol, data_map, gamma, continuous, deterministic, sampling, reduction='none')
+            td_loss = torch.sqrt(bellman_loss*2)
+            return (torch.abs(td_loss) + epsilon) ** alpha
+
+        with torch.no_grad():
             if rnn:
+                # episodes are computed in parallel from initial hidden states
                 qf.reset()
                 targ_qf.reset()
                 pol.reset()
-                keys = ['obs', 'acs', 'next_obs']
-                for key in keys:
-                    data_map[key] = data_map[key].unsqueeze(1)
-            with torch.no_grad():
-                bellman_loss = lf.bellman(
-                    qf, targ_qf, pol, data_map, gamma, continuous, deterministic, sampling, reduction='none')
-                td_loss = torch.sqrt(bellman_loss*2)
-                pris = (torch.abs(td_loss) + epsilon) ** alpha
-                epi['pris'] = pris.cpu().numpy()
+                data_map = dict()
+                for key in columns:
+                    data_map[key], lengths = _pad_epis(columns[key])
+                pris = _pris(data_map).cpu().numpy()
+                epi_pris = [pris[:length, i]
+                            for i, length in enumerate(lengths)]
+            else:
+                keys = list(columns.keys())
+                pris = _forward_in_chunks(lambda *values: _pris(dict(zip(keys, values))),
+                                          *[_cat_epis(columns[key]) for key in keys]).cpu().numpy()
+                epi_pris = _split_epis(
+                    pris, [len(epi['rews']) for epi in epis])
+        for epi, pris in zip(epis, epi_pris):
+            epi['pris'] = pris
         return data
     else:
         raise NotImplementedError(
             "Only Q function with continuous action space is supported now.")
 
 
+def window_pris(pris, seq_length, eta=0.9):
+    """
+    Computing eta * max + (1 - eta) * mean of every window of seq_length.
+    Means are computed from cumulative sums,
+    and maxes by doubling widths of windows in O(T log(seq_length)).
+
+    Parameters
+    ----------
+    pris : ndarray
+        Priorities of steps.
+    seq_length : int
+        Length of windows
+    eta : float
+
+    Returns
+    -------
+    seq_pris : ndarray
+        Priorities of windows starting at each step, the length of which is len(pris) - seq_length + 1.
+    """
+    pris = np.asarray(pris, dtype=np.float64).reshape(-1)
+    n_seq = len(pris) - seq_length + 1
+    if n_seq <= 0:
+        return np.zeros((0, ), dtype='float32')
+    cumsum = np.concatenate([[0], np.cumsum(pris)])
+    means = (cumsum[seq_length:] - cumsum[:n_seq]) / seq_length
+    # maxes[i] is max of pris[i:i+width]
+    maxes = pris
+    width = 1
+    while 2 * width <= seq_length:
+        maxes = np.maximum(maxes[:-width], maxes[width:])
+        width *= 2
+    maxes = np.maximum(
+        maxes[:n_seq], maxes[seq_length - width:seq_length - width + n_seq])
+    return np.array(eta * maxes + (1 - eta) * means, dtype='float32')
+
+
 def compute_seq_pris(data, seq_length, eta=0.9):
     """
     Computing priorities of each sequence in episodes.
@@ -145,12 +258,10 @@ def compute_seq_pris(data, seq_length, eta=0.9):
         epis = data
 
     for epi in epis:
-        n_seq = len(epi['pris']) - seq_length + 1
-        abs_pris = np.abs(epi['pris'])
-        seq_pris = np.array([eta * np.max(abs_pris[i:i+seq_length]) + (1 - eta) *
-                             np.mean(abs_pris[i:i+seq_length]) for i in range(n_seq)], dtype='float32')
-        pad = np.zeros((seq_length - 1,), dtype='float32')
-        epi['seq_pris'] = np.concatenate([seq_pris, pad])
+        seq_pris = np.zeros(len(epi['pris']), dtype='float32')
+        windows = window_pris(np.abs(epi['pris']), seq_length, eta)
+        seq_pris[:len(windows)] = windows
+        epi['seq_pris'] = seq_pris
 
     return data
 
@@ -158,6 +269,7 @@ def compute_seq_pris(data, seq_length, eta=0.9):
 def compute_rets(data, gamma):
     """
     Computing discounted cumulative returns.
+    Returns of truncated segments are bootstrapped from last_v if it exists.
 
     Parameters
     ----------
@@ -178,7 +290,7 @@ def compute_rets(data, gamma):
     for epi in epis:
         rews = epi['rews']
         rets = np.empty(len(rews), dtype=np.float32)
-        last_rew = 0
+        last_rew = epi.get('last_v', 0)
         for t in reversed(range(len(rews))):
             rets[t] = last_rew = rews[t] + gamma * last_rew
         epi['rets'] = rets
@@ -189,6 +301,7 @@ def compute_rets(data, gamma):
 def compute_advs(data, gamma, lam):
     """
     Computing Advantage Function.
+    Advantages of truncated segments are bootstrapped from last_v if it exists.
 
     Parameters
     ----------
@@ -211,7 +324,7 @@ def compute_advs(data, gamma, lam):
     for epi in epis:
         rews = epi['rews']
         vs = epi['vs']
-        vs = np.append(vs, 0)
+        vs = np.append(vs, epi.get('last_v', 0))
         advs = np.empty(len(rews), dtype=np.float32)
         last_gaelam = 0
         for t in reversed(range(len(rews))):
@@ -222,15 +335,36 @@ def compute_advs(data, gamma, lam):
     return data
 
 
+def _slice_hs(hs, num_epi):
+    if isinstance(hs, tuple):
+        return tuple([h[:num_epi] for h in hs])
+    return hs[:num_epi]
+
+
+def _stack_hs(hs):
+    # (num_epi, 2, cell_size) for hs of LSTM
+    if isinstance(hs, tuple):
+        return torch.stack(hs, dim=1)
+    return hs
+
+
 def compute_hs(data, func, hs_name='hs', input_acs=False):
     """
     Computing Hidden State of RNN Cell.
+    Hidden state after each step is computed from the initial hidden state of each episode.
+    Episodes are sorted by length and padded into (time_seq, num_epi) batches
+    of at most FORWARD_BATCH_SIZE steps, and a step of all episodes
+    in a batch is computed by one forward of func.
 
     Parameters
     ----------
     data : Traj or epis(dict of ndarray)
     func : 
         Any function. for example pols, vf and qf.
+    hs_name : str
+        Key of hidden states in epis.
+    input_acs : bool
+        If True, acs are also given to func.
 
     Returns
     -------
@@ -242,25 +376,50 @@ def compute_hs(data, func, hs_name='hs', input_acs=False):
     else:
         epis = data
 
-    func.reset()
+    if len(epis) == 0:
+        return data
+
+    lengths = np.array([len(epi['obs']) for epi in epis])
+    starts = np.cumsum(lengths) - lengths
+    order = np.argsort(-lengths, kind='stable')
+    hs_buf = None
     with torch.no_grad():
-        for epi in epis:
-            obs = torch.tensor(
-                epi['obs'], dtype=torch.float, device=get_device()).unsqueeze(1)
-            time_seq = obs.size()[0]
+        begin = 0
+        while begin < len(order):
+            # the first episode of a batch is the longest one
+            num_epi = max(1, FORWARD_BATCH_SIZE // lengths[order[begin]])
+            batch = order[begin:begin + num_epi]
+            begin += num_epi
+            batch_lengths = lengths[batch]
+            inputs = [_pad_epis([epis[i]['obs'] for i in batch])[0]]
             if input_acs:
-                acs = torch.tensor(
-                    epi['acs'], dtype=torch.float, device=get_device()).unsqueeze(1)
-                hs_seq = [func(obs[i:i+1], acs[i:i+1])[-1]['hs']
-                          for i in range(time_seq)]
-            else:
-                hs_seq = [func(obs[i:i+1])[-1]['hs'] for i in range(time_seq)]
-            if isinstance(hs_seq[0], tuple):
-                hs = np.array([[h.squeeze().detach().cpu().numpy()
-                                for h in hs] for hs in hs_seq], dtype='float32')
-            else:
-                hs = np.array(hs.detach().cpu().numpy(), dtype='float32')
-            epi[hs_name] = hs
+                inputs.append(_pad_epis([epis[i]['acs'] for i in batch])[0])
+
+            func.reset()
+            hs = None
+            hs_seq = []
+            for t in range(batch_lengths[0]):
+                # episodes shorter than t are dropped from the end of the batch
+                num_active = int(np.sum(batch_lengths > t))
+                xs = [x[t:t + 1, :num_active] for x in inputs]
+                if hs is None:
+                    hs = func(*xs)[-1]['hs']
+                else:
+                    hs = func(*xs, hs=_slice_hs(hs, num_active))[-1]['hs']
+                hs_seq.append(_stack_hs(hs))
+            hs_seq = torch.cat(hs_seq, dim=0).cpu().numpy()
+
+            # positions of steps in hs_buf, ordered by time and then episode
+            steps = np.arange(batch_lengths[0])[:, None]
+            index = (starts[batch][None] + steps)[steps < batch_lengths[None]]
+            if hs_buf is None:
+                hs_buf = np.empty((np.sum(lengths), ) +
+                                  hs_seq.shape[1:], dtype='float32')
+            hs_buf[index] = hs_seq
+    func.reset()
+
+    for epi, start, length in zip(epis, starts, lengths):
+        epi[hs_name] = hs_buf[start:start + length]
 
     return data
 
@@ -295,6 +454,7 @@ def centerize_advs(data, eps=1e-6):
 def add_next_obs(data):
     """
     Adding next observations to episodes.
+    Nothing is added to Traj with lazy_next_obs, which gathers them at batch time.
 
     Parameters
     ----------
@@ -306,15 +466,15 @@ def add_next_obs(data):
         Corresponding to input
     """
     if isinstance(data, Traj):
+        if data.lazy_next_obs:
+            return data
         epis = data.current_epis
     else:
         epis = data
 
     for epi in epis:
-        obs = epi['obs']
-        _obs = [ob for ob in obs]
-        next_obs = np.array(_obs[1:] + _obs[:1], dtype=np.float32)
-        epi['next_obs'] = next_obs
+        obs = np.asarray(epi['obs'], dtype=np.float32)
+        epi['next_obs'] = np.concatenate([obs[1:], obs[:1]], axis=0)
 
     return data
 
@@ -351,31 +511,34 @@ def compute_pseudo_rews(data, rew_giver, state_only=False):
         epis = data.current_epis
     else:
         epis = data
+    if len(epis) == 0:
+        return data
 
-    for epi in epis:
-        obs = torch.tensor(epi['obs'], dtype=torch.float, device=get_device())
+    obs = _cat_epis([epi['obs'] for epi in epis])
+    with torch.no_grad():
         if state_only:
-            logits, _ = rew_giver(obs)
+            logits = _forward_in_chunks(lambda o: rew_giver(o)[0], obs)
         else:
-            acs = torch.tensor(
-                epi['acs'], dtype=torch.float, device=get_device())
-            logits, _ = rew_giver(obs, acs)
-        with torch.no_grad():
-            rews = -F.logsigmoid(-logits).cpu().numpy()
+            acs = _cat_epis([epi['acs'] for epi in epis])
+            logits = _forward_in_chunks(
+                lambda o, a: rew_giver(o, a)[0], obs, acs)
+        rews = -F.logsigmoid(-logits).cpu().numpy()
+    for epi, epi_rews in zip(epis, _split_epis(rews, [len(epi['obs']) for epi in epis])):
         epi['real_rews'] = copy.deepcopy(epi['rews'])
-        epi['rews'] = rews
+        epi['rews'] = epi_rews
 
     return data
 
 
 def compute_diayn_rews(data, rew_giver):
     epis = data.current_epis
-    for epi in epis:
-        obs = torch.as_tensor(
-            epi['obs'], dtype=torch.float, device=get_device())
-        with torch.no_grad():
-            rews, info = rew_giver(obs)
-        epi['rews'] = rews.cpu().numpy()
+    if len(epis) == 0:
+        return data
+    obs = _cat_epis([epi['obs'] for epi in epis])
+    with torch.no_grad():
+        rews = _forward_in_chunks(lambda o: rew_giver(o)[0], obs)
+    for epi, epi_rews in zip(epis, _split_epis(rews.cpu().numpy(), [len(epi['obs']) for epi in epis])):
+        epi['rews'] = epi_rews
     return data
 
 
@@ -390,35 +553,61 @@ def train_test_split(epis, train_size):
 
 
 def normalize_obs_and_acs(data, mean_obs=None, std_obs=None, mean_acs=None, std_acs=None, return_statistic=True, eps=1e-6):
-    with torch.no_grad():
-        if isinstance(data, Traj):
-            epis = data.current_epis
-        else:
-            epis = data
-        obs = []
-        acs = []
-        for epi in epis:
-            obs.extend(epi['obs'])
-            acs.extend(epi['acs'])
-        obs = np.array(obs, dtype=np.float32)
-        acs = np.array(acs, dtype=np.float32)
-
-        if mean_obs is None:
-            mean_obs = np.mean(obs, axis=0, keepdims=True)
-        if std_obs is None:
-            std_obs = np.std(
-                obs, axis=0, keepdims=True) + eps
-        if mean_acs is None:
-            mean_acs = np.mean(acs, axis=0, keepdims=True)
-        if std_acs is None:
-            std_acs = np.std(
-                acs, axis=0, keepdims=True) + eps
+    """
+    Normalizing obs, next_obs and acs to mean 0 and std 1.
+    Statistics are computed by RunningMeanStd updated with each episode,
+    without concatenating all steps.
+    If data is a Traj whose epis are registered, its tensors are normalized in place.
 
-        for epi in epis:
-            epi['obs'] = (epi['obs'] - mean_obs) / std_obs
-            epi['acs'] = (epi['acs'] - mean_acs) / std_acs
-            epi['next_obs'] = (
-                epi['next_obs'] - mean_obs) / std_obs
+    Parameters
+    ----------
+    data : Traj or epis(dict of ndarray)
+    mean_obs : ndarray or None
+        If None, it is computed from data. So are std_obs, mean_acs and std_acs.
+    std_obs : ndarray or None
+    mean_acs : ndarray or None
+    std_acs : ndarray or None
+    return_statistic : bool
+        If True, statistics are also returned.
+    eps : float
+        Small value added to std.
+
+    Returns
+    -------
+    data : Traj or epi(dict of ndarray)
+        Corresponding to input
+    mean_obs, std_obs, mean_acs, std_acs : ndarray
+        Returned if return_statistic is True.
+    """
+    if isinstance(data, Traj) and data.current_epis is None:
+        epis = [data.data_map]
+    elif isinstance(data, Traj):
+        epis = data.current_epis
+    else:
+        epis = data
+
+    statistics = []
+    for key, mean, std in (('obs', mean_obs, std_obs), ('acs', mean_acs, std_acs)):
+        if mean is None or std is None:
+            rms = RunningMeanStd(np.shape(epis[0][key])[1:])
+            for epi in epis:
+                rms.update(epi[key])
+            if mean is None:
+                mean = np.array(rms.mean[None], dtype=np.float32)
+            if std is None:
+                std = np.array(rms.std(eps)[None], dtype=np.float32)
+        statistics += [mean, std]
+    mean_obs, std_obs, mean_acs, std_acs = statistics
+
+    for epi in epis:
+        for key, mean, std in (('obs', mean_obs, std_obs), ('next_obs', mean_obs, std_obs), ('acs', mean_acs, std_acs)):
+            if key not in epi:
+                continue
+            if isinstance(epi[key], torch.Tensor):
+                epi[key].sub_(torch.as_tensor(mean, dtype=epi[key].dtype, device=epi[key].device)).div_(
+                    torch.as_tensor(std, dtype=epi[key].dtype, device=epi[key].device))
+            else:
+                epi[key] = (epi[key] - mean) / std
 
     if return_statistic:
         return data, mean_obs, std_obs, mean_acs, std_acs
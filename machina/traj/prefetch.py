@@ -0,0 +1,130 @@
+"""
+Prefetching batches of Traj to cuda.
+Batches are gathered on host by a background thread, pinned and
+copied to the device on a side stream while the previous batch is used.
+"""
+
+import queue
+import threading
+
+import torch
+
+from machina.utils import get_device
+
+
+_local = threading.local()
+
+
+def batch_device():
+    """
+    Device batches of Traj are moved to.
+    It is the host in prefetching threads and get_device() otherwise.
+
+    Returns
+    -------
+    device : torch.device
+    """
+    device = getattr(_local, 'device', None)
+    if device is not None:
+        return device
+    return get_device()
+
+
+def _map_batch(fn, item):
+    # batch dicts are moved, and indices returned with them are kept on host
+    if isinstance(item, dict):
+        return dict([(key, _map_batch(fn, value)) for key, value in item.items()])
+    if isinstance(item, tuple):
+        return tuple([_map_batch(fn, value) if isinstance(value, dict) else value
+                      for value in item])
+    if isinstance(item, torch.Tensor):
+        return fn(item)
+    return item
+
+
+def _put(buf, stop, value):
+    # giving up when the consumer has stopped
+    while not stop.is_set():
+        try:
+            buf.put(value, timeout=0.1)
+            return True
+        except queue.Full:
+            pass
+    return False
+
+
+def _to_device(t, device):
+    if t.is_cuda:
+        return t
+    return t.pin_memory().to(device, non_blocking=True)
+
+
+def _produce(make_iterator, device, stream, buf, stop):
+    _local.device = torch.device('cpu')
+    try:
+        with torch.cuda.device(device):
+            for item in make_iterator():
+                with torch.cuda.stream(stream):
+                    item = _map_batch(lambda t: _to_device(t, device), item)
+                    event = torch.cuda.Event()
+                    event.record(stream)
+                if not _put(buf, stop, (item, event, None)):
+                    return
+    except Exception as e:
+        _put(buf, stop, (None, None, e))
+        return
+    _put(buf, stop, (None, None, StopIteration()))
+
+
+def prefetch(make_iterator, device=None, num_prefetch=2):
+    """
+    Iterating batches with prefetching.
+    While a batch is used, next batches are gathered into pinned memory
+    and copied to the device with non-blocking copies on a side cuda stream.
+    If the device is not cuda, batches are iterated as they are.
+
+    Parameters
+    ----------
+    make_iterator : callable
+        Function making an iterator of batches, which is called in the background thread.
+    device : None or str or torch.device
+        If None, get_device() is used.
+    num_prefetch : int
+        Number of batches prepared ahead.
+        2 means batch k+1 is transferred while batch k is used.
+
+    Returns
+    -------
+    batch : dict of torch.Tensor
+    """
+    device = torch.device(device if device is not None else get_device())
+    if device.type != 'cuda' or not torch.cuda.is_available():
+        for item in make_iterator():
+            yield item
+        return
+
+    stream = torch.cuda.Stream(device)
+    buf = queue.Queue(maxsize=max(1, num_prefetch - 1))
+    stop = threading.Event()
+    thread = threading.Thread(target=_produce, args=(
+        make_iterator, device, stream, buf, stop))
+    thread.daemon = True
+    thread.start()
+    try:
+        while True:
+            item, event, error = buf.get()
+            if isinstance(error, StopIteration):
+                return
+            if error is not None:
+                raise error
+            current_stream = torch.cuda.current_stream(device)
+            current_stream.wait_event(event)
+
+            def _record(t):
+                # memory allocated on the side stream is used on the current stream
+                t.record_stream(current_stream)
+                return t
+            yield _map_batch(_record, item)
+    finally:
+        stop.set()
+        thread.join()
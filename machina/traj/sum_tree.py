@@ -0,0 +1,185 @@
+"""
+Trees of priorities for prioritized sampling from Traj.
+"""
+
+import numpy as np
+
+
+class SumTree(object):
+    """
+    Sum tree and min tree of priorities.
+    Sampling proportional to priorities and updating priorities cost O(log N) per index.
+
+    Parameters
+    ----------
+    pris : ndarray
+        Priorities. They should not be negative.
+    """
+
+    def __init__(self, pris):
+        self._build(np.asarray(pris, dtype=np.float64).reshape(-1))
+
+    def _build(self, pris):
+        self.size = len(pris)
+        self.capacity = 1
+        while self.capacity < self.size:
+            self.capacity *= 2
+        self.sums = np.zeros(2 * self.capacity)
+        # zero priorities are never sampled, so they are ignored in min
+        self.mins = np.full(2 * self.capacity, np.inf)
+        self.sums[self.capacity:self.capacity + self.size] = pris
+        self.mins[self.capacity:self.capacity +
+                  self.size] = np.where(pris > 0, pris, np.inf)
+        width = self.capacity
+        while width > 1:
+            parents = np.arange(width // 2, width)
+            self._pull_up(parents)
+            width //= 2
+
+    def grow(self, size):
+        """
+        Growing the number of priorities to size.
+        Added priorities are zero until they are updated.
+        The tree is built again only when size exceeds capacity,
+        which is doubled at least.
+
+        Parameters
+        ----------
+        size : int
+        """
+        if size <= self.capacity:
+            self.size = max(self.size, size)
+            return
+        pris = np.zeros(max(size, 2 * self.capacity))
+        pris[:self.size] = self.sums[self.capacity:self.capacity + self.size]
+        self._build(pris)
+        self.size = size
+
+    def _pull_up(self, nodes):
+        self.sums[nodes] = self.sums[2 * nodes] + self.sums[2 * nodes + 1]
+        self.mins[nodes] = np.minimum(
+            self.mins[2 * nodes], self.mins[2 * nodes + 1])
+
+    @property
+    def total(self):
+        return self.sums[1]
+
+    @property
+    def min(self):
+        return self.mins[1]
+
+    def get(self, indices):
+        """
+        Priorities of indices.
+
+        Parameters
+        ----------
+        indices : ndarray
+
+        Returns
+        -------
+        pris : ndarray
+        """
+        return self.sums[np.asarray(indices) + self.capacity]
+
+    def update(self, indices, pris):
+        """
+        Updating priorities of indices.
+
+        Parameters
+        ----------
+        indices : ndarray
+        pris : ndarray
+        """
+        nodes = np.asarray(indices, dtype=np.int64).reshape(-1) + self.capacity
+        pris = np.asarray(pris, dtype=np.float64).reshape(-1)
+        self.sums[nodes] = pris
+        self.mins[nodes] = np.where(pris > 0, pris, np.inf)
+        nodes = np.unique(nodes // 2)
+        while len(nodes) > 0 and nodes[-1] >= 1:
+            self._pull_up(nodes)
+            nodes = np.unique(nodes[nodes > 1] // 2)
+
+    def find(self, values):
+        """
+        Finding indices at which prefix sums of priorities exceed values.
+
+        Parameters
+        ----------
+        values : ndarray
+
+        Returns
+        -------
+        indices : ndarray
+        """
+        values = np.array(values, dtype=np.float64)
+        nodes = np.ones(len(values), dtype=np.int64)
+        while self.capacity > 1 and nodes[0] < self.capacity:
+            left = 2 * nodes
+            right = values >= self.sums[left]
+            right &= self.sums[left + 1] > 0
+            values = np.where(right, values - self.sums[left], values)
+            nodes = np.where(right, left + 1, left)
+        return np.minimum(nodes - self.capacity, self.size - 1)
+
+    def sample(self, batch_size):
+        """
+        Stratified sampling proportional to priorities.
+
+        Parameters
+        ----------
+        batch_size : int
+
+        Returns
+        -------
+        indices : ndarray
+        probs : ndarray
+            Sampling probabilities of indices.
+        min_prob : float
+            Minimum sampling probability over positive priorities.
+        """
+        values = (np.arange(batch_size) +
+                  np.random.uniform(size=batch_size)) * self.total / batch_size
+        indices = self.find(values)
+        return indices, self.get(indices) / self.total, self.min / self.total
+
+
+class RankBasedSampler(object):
+    """
+    Rank-based prioritized sampling.
+    Probability of the item of rank r is proportional to (1 / r) ** alpha.
+    Ranks are sorted once and the cumulative distribution is cut into
+    batch_size buckets of equal probability, one index sampled from each bucket.
+
+    Parameters
+    ----------
+    pris : ndarray
+    alpha : float
+    """
+
+    def __init__(self, pris, alpha):
+        pris = np.asarray(pris).reshape(-1)
+        self.order = np.argsort(-pris, kind='stable')
+        probs = (1. / np.arange(1, len(pris) + 1)) ** alpha
+        self.probs = probs / probs.sum()
+        self.cdf = np.cumsum(self.probs)
+        self.alpha = alpha
+
+    def sample(self, batch_size):
+        """
+        Parameters
+        ----------
+        batch_size : int
+
+        Returns
+        -------
+        indices : ndarray
+        probs : ndarray
+            Sampling probabilities of indices.
+        min_prob : float
+        """
+        values = (np.arange(batch_size) +
+                  np.random.uniform(size=batch_size)) / batch_size
+        ranks = np.minimum(np.searchsorted(
+            self.cdf, values * self.cdf[-1], side='right'), len(self.cdf) - 1)
+        return self.order[ranks], self.probs[ranks], self.probs[-1]
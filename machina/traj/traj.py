@@ -2,18 +2,81 @@
 trajectory class
 """
 
+import collections.abc
 import functools
+import json
+import os
 
 import numpy as np
 import torch
 import torch.distributed as dist
-from torch.nn.utils.rnn import pad_sequence
 import torch.utils.data
 
 from machina import loss_functional as lf
+from machina.traj.prefetch import batch_device, prefetch
+from machina.traj.sum_tree import RankBasedSampler, SumTree
 from machina.utils import get_device
 
 LARGE_NUMBER = 1000000000000
+# bytes moved at once when live data of ring buffer is moved
+RING_MOVE_BYTES = 64 * 1024 * 1024
+# default ring_slack is max_steps // RING_SLACK_DIVISOR
+RING_SLACK_DIVISOR = 8
+# ranks of priorities are sorted again after this number of updates of pris
+RANK_RESORT_INTERVAL = 100
+
+# keys of episodes holding one value per episode instead of one per step
+EPI_KEYS = ('truncated', 'last_ob', 'last_v')
+
+
+def _prefetchable(method):
+    # iterating batches through prefetch if traj is in prefetch mode
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        if not self.prefetch:
+            return method(self, *args, **kwargs)
+        return prefetch(lambda: method(self, *args, **kwargs))
+    return wrapper
+
+
+class EpiView(collections.abc.Mapping):
+    """
+    Episode in Traj.
+    Only the range of the episode is held,
+    and each key is sliced from data_map when it is accessed.
+
+    Parameters
+    ----------
+    data_map : dict of torch.Tensor
+    start : int
+    end : int
+    lazy_next_obs : bool
+        If True, next_obs is made from obs as in Traj.
+    """
+
+    def __init__(self, data_map, start, end, lazy_next_obs=False):
+        self.data_map = data_map
+        self.start = start
+        self.end = end
+        self.lazy_next_obs = lazy_next_obs
+
+    def _has_lazy_next_obs(self):
+        return self.lazy_next_obs and 'obs' in self.data_map and 'next_obs' not in self.data_map
+
+    def __getitem__(self, key):
+        if key == 'next_obs' and self._has_lazy_next_obs():
+            obs = self['obs']
+            return torch.cat([obs[1:], obs[:1]])
+        return self.data_map[key][self.start:self.end]
+
+    def __iter__(self):
+        for key in self.data_map:
+            yield key
+        if self._has_lazy_next_obs():
+            yield 'next_obs'
+
+    def __len__(self):
+        return len(self.data_map) + int(self._has_lazy_next_obs())
 
 
 class Traj(object):
@@ -30,9 +93,45 @@ class Traj(object):
         Specifying maximum steps to be saved in Traj.
     traj_device: None or str or torch.device
         Device name Traj is allocated.
+    ring_buffer : bool
+        If True, data is written in place into preallocated storage
+        instead of concatenating whole data at every addition.
+        Old episodes are evicted by advancing the head of storage,
+        and data_map holds views of storage between head and tail.
+    ring_slack : None or int
+        Extra steps of storage in ring_buffer mode.
+        Storage of max_steps + ring_slack steps is allocated at the first registration.
+        Live data is moved to the front of storage only when the slack is used up,
+        so each added step costs max_steps / ring_slack steps of copy on average.
+        If None, max_steps // 8 is used, which takes 1.125 times memory of max_steps.
+    padded_layout : bool
+        If True, the padded layout of episodes used by iterate_rnn
+        is built at every registration instead of at the first iteration.
+    prefetch : bool
+        If True, batch iterators gather next batches into pinned memory on a background thread
+        and copy them to the cuda device on a side stream while the current batch is used.
+        It is effective when traj_device is cpu, and batches are iterated as usual without cuda.
+        Prioritized batches are not prefetched, because each batch should be sampled
+        after priorities of the previous batch are updated.
+    storage_dir : None or str
+        If not None, storage of ring_buffer mode is kept in numpy memmap files
+        in this directory, one file per key, with an index file of episodes.
+        If the directory already has a buffer, it is reopened.
+        When live data is moved, it is copied into new files of the next generation,
+        and old files are removed after the index file refers to new ones,
+        so the buffer can be reopened after a crash at any point.
+        traj_device must be cpu.
+    storage_dtypes : None or dict
+        dtypes data is stored in, e.g. dict(obs='uint8', next_obs='float16').
+        Keys which are not specified are stored in float32.
+        Batches are decoded to float32 on the batch device.
+    lazy_next_obs : bool
+        If True, next_obs is not stored but gathered from obs at batch time.
+        The next observation of the last step of an episode is the first one of the episode
+        as in epi_functional.add_next_obs.
     """
 
-    def __init__(self, max_steps=None, traj_device=None, ddp=False):
+    def __init__(self, max_steps=None, traj_device=None, ddp=False, ring_buffer=False, ring_slack=None, padded_layout=False, prefetch=False, storage_dir=None, storage_dtypes=None, lazy_next_obs=False):
         self.data_map = dict()
         self._next_id = 0
 
@@ -41,6 +140,10 @@ class Traj(object):
 
         self.max_steps = max_steps if max_steps is not None else LARGE_NUMBER
 
+        if storage_dir is not None:
+            if traj_device is not None and torch.device(traj_device).type != 'cpu':
+                raise ValueError('traj_device should be cpu with storage_dir.')
+            traj_device = 'cpu'
         if traj_device is None:
             self.traj_device = lambda: get_device()
         else:
@@ -51,6 +154,40 @@ class Traj(object):
             self.rank = dist.get_rank()
             self.world_size = dist.get_world_size()
 
+        self.ring_buffer = ring_buffer or storage_dir is not None
+        self.ring_slack = ring_slack
+        self._storage = dict()
+        self._head = 0
+        self._tail = 0
+        # memmap files of storage_dir are renewed at each move of live data
+        self._generation = 0
+
+        # trees of priorities built lazily from data_map.
+        # Their leaves are slots of storage, so they are kept while old steps are evicted.
+        self._pri_trees = dict()
+        self._rank_sampler = None
+        self._rank_updates = 0
+
+        self.padded_layout = padded_layout
+        self._padded_layout = None
+
+        self.prefetch = prefetch
+
+        self.lazy_next_obs = lazy_next_obs
+
+        self.storage_dtypes = dict()
+        if storage_dtypes is not None:
+            for key, dtype in storage_dtypes.items():
+                self.storage_dtypes[key] = getattr(
+                    torch, dtype) if isinstance(dtype, str) else dtype
+
+        self.storage_dir = storage_dir
+        if storage_dir is not None:
+            if not os.path.exists(storage_dir):
+                os.makedirs(storage_dir)
+            if os.path.exists(self._storage_path('index.json')):
+                self._load_storage()
+
     @property
     def num_step(self):
         return int(self._epis_index[-1])
@@ -60,15 +197,88 @@ class Traj(object):
         return len(self._epis_index) - 1
 
     def copy(self, traj):
+        self._clear_caches()
         self.data_map = traj.data_map
         self._next_id = traj._next_id
         self.current_epis = traj.current_epis
         self._epis_index = traj._epis_index
         self.max_steps = traj.max_steps
         self.traj_device = traj.traj_device
+        self.storage_dtypes = getattr(traj, 'storage_dtypes', dict())
+        self.lazy_next_obs = getattr(traj, 'lazy_next_obs', False)
+        if getattr(traj, 'ring_buffer', False):
+            self.ring_buffer = traj.ring_buffer
+            self.ring_slack = traj.ring_slack
+            self.storage_dir = traj.storage_dir
+            self._storage = traj._storage
+            self._head = traj._head
+            self._tail = traj._tail
+            self._generation = traj._generation
         if hasattr(self, 'pri_beta') and hasattr(traj, 'pri_beta'):
             self.pri_beta = traj.pri_beta
 
+    def _clear_caches(self):
+        # caches built from data_map, which are stale after data_map changes
+        self._pri_trees = dict()
+        self._rank_sampler = None
+        self._padded_layout = None
+
+    def _pri_tree(self, key):
+        if key not in self._pri_trees:
+            pris = np.zeros(self._head + self.num_step)
+            pris[self._head:] = self.data_map[key].cpu().numpy()
+            self._pri_trees[key] = SumTree(pris)
+        return self._pri_trees[key]
+
+    def _sample_pri_tree(self, key, batch_size):
+        indices, probs, min_prob = self._pri_tree(key).sample(batch_size)
+        return indices - self._head, probs, min_prob
+
+    def _extend_caches(self, pre_head, pre_end):
+        """
+        Updating caches after steps are evicted before head or added after pre_end.
+        Only leaves of trees in these ranges are updated.
+        Trees are dropped if slots of steps are moved.
+        """
+        self._rank_sampler = None
+        self._padded_layout = None
+        end = self._head + self.num_step
+        for key in list(self._pri_trees.keys()):
+            if key not in self.data_map or len(self.data_map[key]) != self.num_step:
+                del self._pri_trees[key]
+                continue
+            tree = self._pri_trees[key]
+            tree.grow(end)
+            tree.update(np.arange(pre_head, min(self._head, pre_end)),
+                        np.zeros(max(min(self._head, pre_end) - pre_head, 0)))
+            start = max(pre_end, self._head)
+            tree.update(np.arange(start, end),
+                        self.data_map[key][start - self._head:].cpu().numpy())
+
+    def update_pri_trees(self, key, indices):
+        """
+        Reflecting priorities of data_map[key] at indices to trees.
+        This should be called after priorities are updated in place.
+        Ranks of priorities are sorted again after RANK_RESORT_INTERVAL updates of pris
+        or when data is added, so rank_based sampling uses stale ranks in between.
+
+        Parameters
+        ----------
+        key : str
+            'pris' or 'seq_pris'
+        indices : ndarray or torch.Tensor
+        """
+        if key == 'pris':
+            self._rank_updates += 1
+            if self._rank_updates >= RANK_RESORT_INTERVAL:
+                self._rank_sampler = None
+        if key in self._pri_trees:
+            if isinstance(indices, torch.Tensor):
+                indices = indices.cpu().numpy()
+            indices = np.asarray(indices, dtype=np.int64)
+            self._pri_trees[key].update(
+                indices + self._head, self.data_map[key][torch.as_tensor(indices)].cpu().numpy())
+
     def get_max_pri(self):
         if 'pris' in self.data_map:
             return torch.max(self.data_map['pris']).cpu()
@@ -83,71 +293,381 @@ class Traj(object):
             for key in data_map:
                 if remain_index is not None:
                     self.data_map[key] = torch.cat(
-                        [self.data_map[key][self._epis_index[remain_index]:], data_map[key].to(self.traj_device())], dim=0)
+                        [self.data_map[key][self._epis_index[remain_index]:], data_map[key].to(self.traj_device(), self._storage_dtype(key, data_map[key].dtype))], dim=0)
                 else:
                     self.data_map[key] = torch.cat(
-                        [self.data_map[key], data_map[key].to(self.traj_device())], dim=0)
+                        [self.data_map[key], data_map[key].to(self.traj_device(), self._storage_dtype(key, data_map[key].dtype))], dim=0)
         else:
             self.data_map = dict()
             for key in data_map:
-                self.data_map[key] = data_map[key].to(self.traj_device())
+                self.data_map[key] = data_map[key].to(
+                    self.traj_device(), self._storage_dtype(key, data_map[key].dtype))
+
+    def _ring_capacity(self):
+        if not self._storage:
+            return 0
+        return list(self._storage.values())[0].size(0)
+
+    def _ring_reserve(self, data_map, add_num_step):
+        capacity = self._ring_capacity()
+        move = self._tail + add_num_step > capacity
+        if not move and all([key in self._storage for key in data_map]):
+            return
+        num_step = self._tail - self._head
+        required = num_step + add_num_step
+        if self.max_steps < LARGE_NUMBER:
+            # storage of max_steps + slack is allocated once
+            slack = self.ring_slack if self.ring_slack is not None else self.max_steps // RING_SLACK_DIVISOR
+            capacity = max(capacity, self.max_steps + slack, required)
+        elif required > capacity // 2:
+            # growing storage by doubling because max_steps is not given
+            capacity = max(2 * capacity, required, 1024)
+        move = move or capacity != self._ring_capacity()
+        # files of the index must not be overwritten, so live data is moved to new files
+        renew = move and self.storage_dir is not None
+        generation = self._generation + 1 if renew else self._generation
+        storage = dict()
+        for key in set(self._storage) | set(data_map):
+            if key in self._storage:
+                old = self._storage[key]
+                shape, dtype = old.shape[1:], old.dtype
+            else:
+                old = None
+                shape, dtype = data_map[key].shape[1:], self._storage_dtype(
+                    key, data_map[key].dtype)
+            if old is not None and old.size(0) == capacity and not renew:
+                if move:
+                    # moving live data to the front of storage in chunks
+                    self._ring_copy(old, old[self._head:self._tail])
+                storage[key] = old
+                continue
+            storage[key] = self._ring_allocate(
+                key, capacity, shape, dtype, generation)
+            if old is not None:
+                self._ring_copy(storage[key], old[self._head:self._tail])
+        old_keys = list(self._storage)
+        self._storage = storage
+        if move:
+            self._head = 0
+            self._tail = num_step
+            # slots of steps are moved
+            self._pri_trees = dict()
+        if renew:
+            self._generation = generation
+            self.data_map = dict([(key, self._storage[key][self._head:self._tail])
+                                  for key in self._storage])
+            self._save_storage()
+            for key in old_keys:
+                os.remove(self._storage_path(
+                    self._storage_file(key, generation - 1)))
+
+    def _ring_copy(self, dst, src):
+        # copying in chunks bounds the temporary copy for memmap storage
+        step_bytes = max(1, src[:1].numel() * src.element_size())
+        chunk = max(1, RING_MOVE_BYTES // step_bytes)
+        for start in range(0, len(src), chunk):
+            end = min(start + chunk, len(src))
+            dst[start:end] = src[start:end].clone()
+
+    def _ring_allocate(self, key, capacity, shape, dtype, generation):
+        if self.storage_dir is None:
+            return torch.zeros(
+                (capacity, ) + tuple(shape), dtype=dtype, device=self.traj_device())
+        arr = np.lib.format.open_memmap(
+            self._storage_path(self._storage_file(key, generation)), mode='w+',
+            dtype=torch.zeros(0, dtype=dtype).numpy().dtype, shape=(capacity, ) + tuple(shape))
+        return torch.from_numpy(arr)
+
+    def _storage_file(self, key, generation):
+        return '{}.{}.npy'.format(key, generation)
+
+    def _storage_path(self, name):
+        return os.path.join(self.storage_dir, name)
+
+    def _save_storage(self):
+        """
+        Writing the index of episodes in storage_dir.
+        It is replaced atomically after data is written, so it never refers to unwritten steps.
+        Steps it refers to are never overwritten, because live data is moved to new files.
+        """
+        index = dict(keys=sorted(self._storage), head=self._head, tail=self._tail,
+                     epis_index=[int(i) for i in self._epis_index], generation=self._generation)
+        path = self._storage_path('index.json')
+        with open(path + '.tmp', 'w') as f:
+            json.dump(index, f)
+        os.replace(path + '.tmp', path)
+
+    def _load_storage(self):
+        """
+        Reopening a buffer written in storage_dir.
+        """
+        with open(self._storage_path('index.json')) as f:
+            index = json.load(f)
+        self._generation = index['generation']
+        self._storage = dict([(key, torch.from_numpy(np.load(
+            self._storage_path(self._storage_file(key, self._generation)), mmap_mode='r+'))) for key in index['keys']])
+        self._head = index['head']
+        self._tail = index['tail']
+        self._epis_index = np.array(index['epis_index'], dtype=np.int64)
+        self.data_map = dict([(key, self._storage[key][self._head:self._tail])
+                              for key in self._storage])
+        # files of other generations are left by a crash while live data was moved
+        files = set([self._storage_file(key, self._generation)
+                     for key in self._storage])
+        for name in os.listdir(self.storage_dir):
+            if name.endswith('.npy') and name not in files:
+                os.remove(self._storage_path(name))
+
+    def _take(self, key, index):
+        """
+        Gathering steps of data_map[key] at index into a batch.
+        Reading memmap storage in the order of index is slow,
+        so sorted indices are read and the result is permuted back.
+        """
+        if key not in self.data_map and key == 'next_obs':
+            return self._take('obs', self._next_indices(index))
+        data = self.data_map[key]
+        if isinstance(index, torch.Tensor):
+            index = index.to(data.device)
+        if self.storage_dir is None:
+            taken = data[index]
+        else:
+            index = torch.as_tensor(index, dtype=torch.long)
+            sorted_index, order = torch.sort(index.reshape(-1))
+            taken = torch.empty(
+                (len(order), ) + data.shape[1:], dtype=data.dtype)
+            taken[order] = data[sorted_index]
+            taken = taken.reshape(index.shape + data.shape[1:])
+        return self._decode(key, taken.to(batch_device()))
+
+    def _batch_keys(self):
+        keys = list(self.data_map.keys())
+        if self.lazy_next_obs and 'obs' in self.data_map and 'next_obs' not in self.data_map:
+            keys.append('next_obs')
+        return keys
+
+    def _next_indices(self, index):
+        """
+        Indices of next steps.
+        The next step of the last step of an episode is the first step of the episode.
+        """
+        index = torch.as_tensor(index, dtype=torch.long)
+        steps = index.cpu().numpy()
+        epis = np.searchsorted(self._epis_index, steps, side='right') - 1
+        next_steps = steps + 1
+        last = next_steps == self._epis_index[epis + 1]
+        next_steps[last] = self._epis_index[epis[last]]
+        return torch.as_tensor(next_steps).to(index.device)
+
+    def _storage_dtype(self, key, default=torch.float):
+        if key in self.storage_dtypes:
+            return self.storage_dtypes[key]
+        return default
+
+    def _decode(self, key, value):
+        # values stored in compact dtypes are decoded on the batch device
+        if key in self.storage_dtypes:
+            return value.float()
+        return value
+
+    def _ring_evict(self, add_num_step):
+        # evicting oldest episodes so that max_steps is not exceeded
+        excess = self.num_step + add_num_step - self.max_steps
+        if excess > 0:
+            remain_index = int(np.searchsorted(
+                self._epis_index, excess, side='left'))
+            self._head += int(self._epis_index[remain_index])
+            self._epis_index = self._epis_index[remain_index:] - \
+                self._epis_index[remain_index]
 
-    def register_epis(self):
-        epis = self.current_epis
-        keys = epis[0].keys()
-        data_map = dict()
-        for key in keys:
+    def _ring_commit(self, epis_index):
+        # exposing steps written after tail
+        self._tail += int(epis_index[-1])
+        self._epis_index = np.concatenate(
+            [self._epis_index, np.asarray(epis_index[1:]) + self._epis_index[-1]])
+        self.data_map = dict([(key, self._storage[key][self._head:self._tail])
+                              for key in self._storage])
+        if self.storage_dir is not None:
+            self._save_storage()
+
+    def _ring_add(self, data_map, epis_index):
+        """
+        Writing data in place.
+        Oldest episodes are evicted if max_steps is exceeded.
+        """
+        add_num_step = int(epis_index[-1])
+        self._ring_evict(add_num_step)
+        self._ring_reserve(data_map, add_num_step)
+        for key in data_map:
+            self._storage[key][self._tail:self._tail +
+                               add_num_step] = data_map[key][:add_num_step]
+        self._ring_commit(epis_index)
+
+    def _epi_columns(self, epis):
+        """
+        Arrays of each key of epis.
+        Values of nested dicts such as a_is are flattened.
+        """
+        columns = dict()
+        for key in epis[0]:
+            if key in EPI_KEYS:
+                # values per episode are not stored
+                continue
             if isinstance(epis[0][key], list) or isinstance(epis[0][key], np.ndarray):
-                data_map[key] = torch.tensor(np.concatenate(
-                    [epi[key] for epi in epis], axis=0), dtype=torch.float, device=self.traj_device())
+                columns[key] = [epi[key] for epi in epis]
             elif isinstance(epis[0][key], dict):
-                new_keys = epis[0][key].keys()
-                for new_key in new_keys:
-                    data_map[new_key] = torch.tensor(np.concatenate(
-                        [epi[key][new_key] for epi in epis], axis=0), dtype=torch.float, device=self.traj_device())
-
-        self._concat_data_map(data_map)
-
-        epis_index = []
-        index = 0
-        for epi in epis:
-            l_epi = len(epi['rews'])
-            index += l_epi
-            epis_index.append(index)
-        epis_index = np.array(epis_index) + self._epis_index[-1]
-        self._epis_index = np.concatenate([self._epis_index, epis_index])
+                for new_key in epis[0][key]:
+                    columns[new_key] = [epi[key][new_key] for epi in epis]
+        return columns
+
+    def _write_arrays(self, dst, arrays):
+        """
+        Writing arrays consecutively into dst.
+        Arrays are cast while they are written, so they are copied only once.
+        """
+        if dst.device.type != 'cpu':
+            # staged on host and sent in one copy
+            staging = torch.empty(dst.shape, dtype=dst.dtype)
+            self._write_arrays(staging, arrays)
+            dst.copy_(staging)
+            return
+        view = dst.numpy()
+        start = 0
+        for arr in arrays:
+            arr = np.asarray(arr)
+            view[start:start + len(arr)] = arr
+            start += len(arr)
+
+    def register_epis(self):
+        """
+        Registering epis added by add_epis.
+        Each key is allocated once and arrays of episodes are written into it.
+        """
+        pre_head, pre_end = self._head, self._head + self.num_step
+        epis = self.current_epis
+        lengths = np.array([len(epi['rews']) for epi in epis], dtype=np.int64)
+        epis_index = np.concatenate([[0], np.cumsum(lengths)])
+        add_num_step = int(epis_index[-1])
+        if self.ring_buffer and add_num_step > self.max_steps:
+            # only the newest episodes which fit in max_steps are kept
+            first = int(np.searchsorted(
+                epis_index, add_num_step - self.max_steps, side='left'))
+            if first == len(epis):
+                raise ValueError(
+                    'max_steps should be larger than the number of steps in one episode.')
+            epis = epis[first:]
+            epis_index = epis_index[first:] - epis_index[first]
+            add_num_step = int(epis_index[-1])
+            self._head = self._tail = 0
+            self._epis_index = np.array([0])
+            self._pri_trees = dict()
+        columns = self._epi_columns(epis)
+
+        if self.ring_buffer:
+            templates = dict()
+            for key, arrays in columns.items():
+                templates[key] = torch.empty(
+                    (0, ) + np.asarray(arrays[0]).shape[1:], dtype=self._storage_dtype(key))
+            self._ring_evict(add_num_step)
+            self._ring_reserve(templates, add_num_step)
+            for key, arrays in columns.items():
+                self._write_arrays(
+                    self._storage[key][self._tail:self._tail + add_num_step], arrays)
+            self._ring_commit(epis_index)
+        else:
+            pre_num_step = self.num_step
+            data_map = dict()
+            for key, arrays in columns.items():
+                # steps before a new key are filled with zeros
+                allocate = torch.empty if key in self.data_map else torch.zeros
+                data_map[key] = allocate(
+                    (pre_num_step + add_num_step, ) +
+                    np.asarray(arrays[0]).shape[1:],
+                    dtype=self._storage_dtype(key), device=self.traj_device())
+                if key in self.data_map:
+                    data_map[key][:pre_num_step] = self.data_map[key]
+                self._write_arrays(data_map[key][pre_num_step:], arrays)
+            self.data_map.update(data_map)
+            self._epis_index = np.concatenate(
+                [self._epis_index, epis_index[1:] + self._epis_index[-1]])
 
         self.current_epis = None
+        self._extend_caches(pre_head, pre_end)
+
+        if self.padded_layout:
+            self._get_padded_layout()
+
+    def _added_data_map(self, traj):
+        """
+        data_map of traj in the layout of next_obs of this Traj.
+        next_obs is gathered from obs of a lazy traj,
+        and it is not stored in a lazy Traj.
+        """
+        data_map = dict(traj.data_map)
+        if self.lazy_next_obs:
+            data_map.pop('next_obs', None)
+        elif 'next_obs' not in data_map and 'next_obs' in traj._batch_keys():
+            data_map['next_obs'] = traj.data_map['obs'][traj._next_indices(
+                torch.arange(traj.num_step))]
+        return data_map
 
     def add_traj(self, traj):
+        """
+        Adding data of traj.
+        If lazy_next_obs of traj differs from this Traj,
+        next_obs is materialized or dropped accordingly.
+
+        Parameters
+        ----------
+        traj : Traj
+        """
+        pre_head, pre_end = self._head, self._head + self.num_step
+        data_map = self._added_data_map(traj)
         epis_index = traj._epis_index
         pre_num_step = self.num_step
         add_num_step = traj.num_step
-        if pre_num_step + add_num_step <= self.max_steps:
-            self._concat_data_map(traj.data_map)
+        if self.ring_buffer:
+            if add_num_step > self.max_steps:
+                remain_index = int(np.searchsorted(
+                    epis_index, self.max_steps, side='right')) - 1
+                if remain_index == 0:
+                    raise ValueError(
+                        'max_steps should be larger than the number of steps in one episode.')
+                epis_index = epis_index[:remain_index + 1]
+                self._head = self._tail = 0
+                self._epis_index = np.array([0])
+                self._pri_trees = dict()
+            self._ring_add(data_map, epis_index)
+        elif pre_num_step + add_num_step <= self.max_steps:
+            self._concat_data_map(data_map)
             epis_index = epis_index + self._epis_index[-1]
             self._epis_index = np.concatenate(
                 [self._epis_index, epis_index[1:]])
         elif add_num_step <= self.max_steps:
+            # steps are shifted to the front
+            self._pri_trees = dict()
             remain_index = 0
             while self.max_steps < pre_num_step + add_num_step - self._epis_index[remain_index]:
                 remain_index += 1
-            self._concat_data_map(traj.data_map, remain_index)
+            self._concat_data_map(data_map, remain_index)
             self._epis_index = self._epis_index[remain_index:] - \
                 self._epis_index[remain_index]
             epis_index = epis_index + self._epis_index[-1]
             self._epis_index = np.concatenate(
                 [self._epis_index, epis_index[1:]])
         else:  # self.max_steps < add_step
+            self._pri_trees = dict()
             remain_index = -1
             while self.max_steps < epis_index[remain_index]:
                 if remain_index == - len(epis_index):
                     raise ValueError(
                         'max_steps should be larger than the number of steps in one episode.')
                 remain_index -= 1
-            for key in traj.data_map:
-                self.data_map[key] = traj.data_map[key][:epis_index[remain_index]]
+            for key in data_map:
+                self.data_map[key] = data_map[key][:epis_index[remain_index]].to(
+                    self.traj_device(), self._storage_dtype(key, data_map[key].dtype))
             self._epis_index = traj._epis_index[:remain_index+1]
+        self._extend_caches(pre_head, pre_end)
 
     def _shuffled_indices(self, indices):
         return indices[torch.randperm(len(indices))]
@@ -172,10 +692,11 @@ class Traj(object):
             indices = indices[cur_id:cur_id + batch_size]
 
         data_map = dict()
-        for key in self.data_map:
-            data_map[key] = self.data_map[key][indices].to(get_device())
+        for key in self._batch_keys():
+            data_map[key] = self._take(key, indices)
         return data_map
 
+    @_prefetchable
     def iterate_once(self, batch_size, indices=None, shuffle=True):
         """
         Iterate a full of trajectory once.
@@ -198,6 +719,7 @@ class Traj(object):
             yield self._next_batch(batch_size, indices)
         self._next_id = 0
 
+    @_prefetchable
     def iterate(self, batch_size, epoch=1, indices=None, shuffle=True):
         """
         Iterate a full of trajectory epoch times.
@@ -222,6 +744,7 @@ class Traj(object):
                 yield self._next_batch(batch_size, indices)
             self._next_id = 0
 
+    @_prefetchable
     def iterate_step(self, batch_size, step=1, indices=None, shuffle=True):
         indices = self._get_indices(indices, shuffle)
         for _ in range(step):
@@ -254,15 +777,14 @@ class Traj(object):
             indices = indices[self.rank:len(indices):self.world_size]
 
         data_map = dict()
-        for key in self.data_map:
-            data_map[key] = self.data_map[key][indices].to(
-                get_device())
+        for key in self._batch_keys():
+            data_map[key] = self._take(key, indices)
         if return_indices:
             return data_map, indices
         else:
             return data_map
 
-    def prioritized_random_batch_once(self, batch_size, return_indices=False, mode='proportional', alpha=0.6, init_beta=0.4, beta_step=0.00025/4):
+    def _anneal_pri_beta(self, init_beta, beta_step):
         if hasattr(self, 'pri_beta') == False:
             self.pri_beta = init_beta
         elif self.pri_beta >= 1.0:
@@ -270,66 +792,89 @@ class Traj(object):
         else:
             self.pri_beta += beta_step
 
-        pris = self.data_map['pris'].cpu().numpy()
+    def prioritized_random_batch_once(self, batch_size, return_indices=False, mode='proportional', alpha=0.6, init_beta=0.4, beta_step=0.00025/4):
+        """
+        Providing a batch which is sampled according to priorities.
+        Priorities are kept in a sum tree, so sampling costs O(batch_size log N).
+        Importance sampling weights normalized by their maximum are in is_weights of the batch.
+
+        Parameters
+        ----------
+        batch_size : int
+        return_indices : bool
+            If True, indices are also returned.
+        mode : str
+            'proportional' or 'rank_based'
+        alpha : float
+            Exponent of rank in rank_based mode.
+        init_beta : float
+            Initial exponent of importance sampling weights.
+        beta_step : float
+            Increment of beta at each call.
+
+        Returns
+        -------
+        data_map : dict of torch.Tensor
+        """
+        self._anneal_pri_beta(init_beta, beta_step)
 
         if mode == 'rank_based':
-            index = np.argsort(-pris)
-            pris = (index.astype(np.float32)+1) ** -1
-            pris = pris ** alpha
-
-        is_weights = (len(pris) * (pris/pris.sum())) ** -self.pri_beta
-        is_weights /= np.max(is_weights)
-        pris *= is_weights
-        pris = torch.tensor(pris)
-        indices = torch.utils.data.sampler.WeightedRandomSampler(
-            pris, batch_size, replacement=True)
-        indices = [index for index in indices]
+            if self._rank_sampler is None or self._rank_sampler.alpha != alpha:
+                self._rank_sampler = RankBasedSampler(
+                    self.data_map['pris'].cpu().numpy(), alpha)
+                self._rank_updates = 0
+            indices, probs, min_prob = self._rank_sampler.sample(batch_size)
+        else:
+            indices, probs, min_prob = self._sample_pri_tree(
+                'pris', batch_size)
+        is_weights = (probs / min_prob) ** -self.pri_beta
+        indices = torch.tensor(indices, dtype=torch.long)
+        is_weights = torch.tensor(
+            is_weights, dtype=torch.float, device=batch_device())
 
         if self.ddp:
             indices = indices[self.rank:len(indices):self.world_size]
+            is_weights = is_weights[self.rank:len(
+                is_weights):self.world_size]
 
         data_map = dict()
-        for key in self.data_map:
-            data_map[key] = self.data_map[key][indices].to(get_device())
+        for key in self._batch_keys():
+            data_map[key] = self._take(key, indices)
+        data_map['is_weights'] = is_weights
         if return_indices:
             return data_map, indices
         else:
             return data_map
 
     def prioritized_random_batch_rnn_once(self, batch_size, seq_length, return_indices=False, init_beta=0.4, beta_step=0.00025/4):
-        if hasattr(self, 'pri_beta') == False:
-            self.pri_beta = init_beta
-        elif self.pri_beta >= 1.0:
-            self.pri_beta = 1.0
-        else:
-            self.pri_beta += beta_step
-
-        seq_pris = self.data_map['seq_pris'].clone().detach()
+        self._anneal_pri_beta(init_beta, beta_step)
 
-        start_indices = torch.utils.data.sampler.WeightedRandomSampler(
-            seq_pris, batch_size)  # , replacement=True)
-        start_indices = [idx for idx in start_indices]
+        start_indices, _, _ = self._sample_pri_tree('seq_pris', batch_size)
+        start_indices = torch.tensor(start_indices, dtype=torch.long)
 
-        seqs = []
-        length = []
-        for start in start_indices:
-            data_map = dict()
-            for key in self.data_map:
-                data_map[key] = self.data_map[key][start: start+seq_length]
-            seqs.append(data_map)
-
-        batch = dict()
-        keys = seqs[0].keys()
-        for key in keys:
-            batch[key] = torch.stack([seq[key] for seq in seqs], dim=0)
-            # (batch_size, seq_length, *) -> (seq_length, batch_size, *)
-            batch[key] = batch[key].transpose(0, 1).to(get_device())
+        index = start_indices.unsqueeze(
+            0) + torch.arange(seq_length).unsqueeze(1)
+        batch = self._gather_seqs(index.clamp(max=self.num_step - 1))
 
         if return_indices:
             return batch, start_indices
         else:
             return batch
 
+    def _gather_seqs(self, index, masks=None):
+        """
+        Gathering sequences by an index of shape (seq_length, batch_size).
+        Steps where masks is 0 are filled with zeros.
+        """
+        batch = dict()
+        for key in self._batch_keys():
+            # (seq_length, batch_size, *)
+            batch[key] = self._take(key, index)
+            if masks is not None:
+                batch[key][masks.to(batch_device()) == 0] = 0
+        return batch
+
+    @_prefetchable
     def random_batch(self, batch_size, epoch=1, indices=None, return_indices=False):
         """
         Providing batches which is randomly sampled from trajectory.
@@ -358,10 +903,12 @@ class Traj(object):
                     batch_size, indices, return_indices)
                 yield batch
 
+    @_prefetchable
     def random_batch_rnn(self, batch_size, seq_length=None, epoch=1):
         """
         Providing sequences of batch which is randomly sampled from trajectory.
         batch shape is (seq_length, batch_size, * )
+        Steps after the end of episodes are filled with zeros and out_masks is 0 there.
 
         Parameters
         ----------
@@ -376,47 +923,29 @@ class Traj(object):
         batch : dict of torch.Tensor
         """
 
+        epi_lengths = np.diff(self._epis_index)
         if seq_length is None:
-            seq_length = max([self._epis_index[i+1] - self._epis_index[i]
-                              for i in range(len(self._epis_index)-1)])
+            seq_length = int(np.max(epi_lengths))
 
         for _ in range(epoch):
-            seqs = []
-            lengths = []
             indices = np.random.randint(
                 0, len(self._epis_index)-1, (batch_size,))
 
             if self.ddp:
                 indices = indices[self.rank:len(indices):self.world_size]
 
-            for idx in indices:
-                length = min(
-                    self._epis_index[idx+1] - self._epis_index[idx], seq_length)
-                start = np.random.randint(
-                    self._epis_index[idx], self._epis_index[idx+1] - length + 1)
-                data_map = dict()
-                for key in self.data_map:
-                    if self._epis_index[-1] - self._epis_index[idx] < seq_length:
-                        pad = torch.zeros_like(self.data_map[key][:seq_length-length],
-                                               dtype=torch.float, device=get_device())
-                        data_map[key] = torch.cat(
-                            [self.data_map[key][start: start+length], pad])
-                    else:
-                        data_map[key] = self.data_map[key][start: start+seq_length]
-                lengths.append(length)
-                seqs.append(data_map)
-
-            batch = dict()
-            keys = seqs[0].keys()
-            for key in keys:
-                batch[key] = torch.stack([seq[key] for seq in seqs])
-                # (batch_size, seq_length, *) -> (seq_length, batch_size, *)
-                batch[key] = batch[key].transpose(0, 1).to(get_device())
-            out_masks = torch.ones(
-                (seq_length, batch_size), dtype=torch.float, device=get_device())
-            for i in range(batch_size):
-                out_masks[lengths[i]:, i] = 0
-            batch['out_masks'] = out_masks
+            lengths = np.minimum(epi_lengths[indices], seq_length)
+            starts = self._epis_index[indices] + np.floor(np.random.uniform(
+                size=len(indices)) * (epi_lengths[indices] - lengths + 1)).astype(np.int64)
+
+            steps = torch.arange(seq_length).unsqueeze(1)
+            out_masks = (steps < torch.as_tensor(lengths).unsqueeze(0)).float()
+            index = torch.as_tensor(starts).unsqueeze(0) + steps
+            # padded steps are masked and filled with zeros
+            index = index.clamp(max=self.num_step - 1)
+
+            batch = self._gather_seqs(index, out_masks)
+            batch['out_masks'] = out_masks.to(batch_device())
             yield batch
 
     def prioritized_random_batch(self, batch_size, epoch=1, return_indices=False):
@@ -455,10 +984,11 @@ class Traj(object):
                     batch_size, seq_length, return_indices)
                 yield batch, start_indices
             else:
-                batch = self.prioritized_random_batch_once(
+                batch = self.prioritized_random_batch_rnn_once(
                     batch_size, seq_length, return_indices)
                 yield batch
 
+    @_prefetchable
     def full_batch(self, epoch=1, return_indices=False):
         """
         Providing whole trajectory as batch.
@@ -474,8 +1004,12 @@ class Traj(object):
         data_map : dict of torch.Tensor
         """
         data_map = dict()
-        for key in self.data_map:
-            data_map[key] = self.data_map[key].to(get_device())
+        for key in self._batch_keys():
+            if key in self.data_map:
+                data_map[key] = self._decode(
+                    key, self.data_map[key].to(batch_device()))
+            else:
+                data_map[key] = self._take(key, torch.arange(self.num_step))
         for _ in range(epoch):
             if return_indices:
                 yield data_map, torch.arange(self.num_step)
@@ -492,25 +1026,90 @@ class Traj(object):
 
         Returns
         -------
-        epis : dict of torch.Tensor
+        epi : EpiView
+            dict like view of an episode, keys of which are sliced when accessed.
         """
-        epis = []
-        for i in range(len(self._epis_index) - 1):
-            data_map = dict()
-            for key in self.data_map:
-                data_map[key] = self.data_map[key][self._epis_index[i]:self._epis_index[i+1]]
-            epis.append(data_map)
         if shuffle:
-            indices = np.random.permutation(range(len(epis)))
+            indices = np.random.permutation(self.num_epi)
         else:
-            indices = range(len(epis))
+            indices = range(self.num_epi)
         for idx in indices:
-            yield epis[idx]
+            yield EpiView(self.data_map, int(self._epis_index[idx]), int(self._epis_index[idx+1]),
+                          self.lazy_next_obs)
+
+    def epi_lengths(self):
+        """
+        Lengths of episodes.
+
+        Returns
+        -------
+        lengths : ndarray
+        """
+        return np.diff(self._epis_index)
+
+    def _reduce_epis(self, ufunc, key):
+        if self.num_epi == 0:
+            return np.zeros((0, ) + tuple(self.data_map[key].shape[1:]))
+        values = self._decode(key, self.data_map[key]).detach().cpu().numpy()
+        return ufunc.reduceat(values, self._epis_index[:-1], axis=0)
+
+    def epi_sums(self, key='rews'):
+        """
+        Sums of a key over each episode, e.g. undiscounted returns for rews.
+
+        Parameters
+        ----------
+        key : str
+
+        Returns
+        -------
+        sums : ndarray
+        """
+        return self._reduce_epis(np.add, key)
+
+    def epi_maxes(self, key='pris'):
+        """
+        Maximums of a key over each episode, e.g. max priorities for pris.
+
+        Parameters
+        ----------
+        key : str
+
+        Returns
+        -------
+        maxes : ndarray
+        """
+        return self._reduce_epis(np.maximum, key)
+
+    def _get_padded_layout(self):
+        """
+        Padded layout of episodes.
+        index[t, i] is the step of time t in i-th episode.
+        Times after the end of episodes point to the last step of episodes.
 
+        Returns
+        -------
+        layout : dict of torch.Tensor
+            index of shape (max_length, num_epi) and lengths of shape (num_epi, ).
+        """
+        if self._padded_layout is None:
+            starts = torch.as_tensor(self._epis_index[:-1], dtype=torch.long)
+            lengths = torch.as_tensor(
+                np.diff(self._epis_index), dtype=torch.long)
+            max_length = int(lengths.max()) if len(lengths) > 0 else 0
+            steps = torch.arange(max_length).unsqueeze(1)
+            index = torch.min(steps, lengths.unsqueeze(0) - 1) + \
+                starts.unsqueeze(0)
+            self._padded_layout = dict(index=index, lengths=lengths)
+        return self._padded_layout
+
+    @_prefetchable
     def iterate_rnn(self, batch_size, num_epi_per_seq=1, epoch=1):
         """
         Iterating batches for rnn.
         batch shape is (max_seq, batch_size, * )
+        Steps after the end of sequences are filled with zeros and out_masks is 0 there.
+        Episodes are gathered by the padded layout, which is built once per registration.
 
         Parameters
         ----------
@@ -524,41 +1123,29 @@ class Traj(object):
         batch : dict of torch.Tensor
         """
         assert batch_size * num_epi_per_seq <= self.num_epi
+        layout = self._get_padded_layout()
+        num_seq = self.num_epi // num_epi_per_seq
         for _ in range(epoch):
-            epi_count = 0
-            all_batch = []
-            seq = []
-            for epi in self.iterate_epi(shuffle=True):
-                seq.append(epi)
-                epi_count += 1
-                if epi_count >= num_epi_per_seq:
-                    _seq = dict()
-                    for key in seq[0].keys():
-                        _seq[key] = torch.cat([s[key] for s in seq])
-                    all_batch.append(_seq)
-                    seq = []
-                    epi_count = 0
-            num_batch = len(all_batch)
-            idx = 0
-            while idx <= num_batch - batch_size:
-                cur_batch_size = min(batch_size, num_batch - idx)
-                batch = all_batch[idx:idx+cur_batch_size]
-                idx += cur_batch_size
-
-                lengths = [list(b.values())[0].size(0) for b in batch]
-                max_length = max(lengths)
-                out_masks = torch.ones(
-                    (max_length, cur_batch_size), dtype=torch.float, device=get_device())
-                time_slice = list(functools.reduce(
-                    lambda x, y: x+y, [list(range(l, max_length)) for l in lengths]))
-                batch_idx = list(functools.reduce(
-                    lambda x, y: x+y, [(max_length - l) * [i] for i, l in enumerate(lengths)]))
-                out_masks[time_slice, batch_idx] = 0
-
-                _batch = dict()
-                keys = batch[0].keys()
-                for key in keys:
-                    _batch[key] = pad_sequence(
-                        [b[key] for b in batch]).to(get_device())
-                _batch['out_masks'] = out_masks.to(get_device())
-                yield _batch
+            # episodes in a sequence are concatenated
+            seqs = torch.randperm(self.num_epi)[
+                :num_seq * num_epi_per_seq].view(num_seq, num_epi_per_seq)
+            for idx in range(0, num_seq - batch_size + 1, batch_size):
+                epis = seqs[idx:idx+batch_size]
+                lengths = layout['lengths'][epis]
+                ends = torch.cumsum(lengths, dim=1)
+                max_length = int(ends[:, -1].max())
+                steps = torch.arange(max_length).view(-1, 1, 1)
+                # position of the episode each time belongs to
+                pos = torch.sum(steps >= ends.unsqueeze(0), dim=2).clamp(
+                    max=num_epi_per_seq - 1)
+                epi = torch.gather(epis.t(), 0, pos)
+                local_steps = steps.squeeze(2) - \
+                    torch.gather((ends - lengths).t(), 0, pos)
+                local_steps = local_steps.clamp(
+                    max=layout['index'].size(0) - 1)
+                out_masks = (steps.view(-1, 1) <
+                             ends[:, -1].unsqueeze(0)).float()
+                batch = self._gather_seqs(
+                    layout['index'][local_steps, epi], out_masks)
+                batch['out_masks'] = out_masks.to(batch_device())
+                yield batch
@@ -2,26 +2,33 @@
 These are functions which is applied to trajectory.
 """
 
-import time
-
-import cloudpickle
 import torch
 import torch.distributed as dist
 import numpy as np
 
 from machina import loss_functional as lf
-from machina.utils import get_device, get_redis, _int
+from machina.traj import epi_functional as ef
+from machina.traj import wire
+from machina.utils import get_device, get_redis
+
+# number of steps scanned in parallel in _discounted_scan
+SCAN_CHUNK_SIZE = 64
 
 
-def sync(traj, master_rank=0):
+def sync(traj, master_rank=0, compress=None, obs_dtype=None):
     """
     Synchronize trajs. This function is used in multi node situation, and use redis.
+    Registered data of traj is sent in the format of machina.traj.wire.
 
     Parameters
     ----------
     traj : Traj
     master_rank : int
         master_rank's traj is scattered
+    compress : str or None
+        None, 'lz4' or 'zstd'.
+    obs_dtype : str or None
+        If not None, observations are sent in this dtype, e.g. 'float16'.
 
     Returns
     -------
@@ -30,28 +37,20 @@ def sync(traj, master_rank=0):
     rank = traj.rank
     r = get_redis()
     if rank == master_rank:
-        obj = cloudpickle.dumps(traj)
-        r.set('Traj', obj)
-        triggers = {'Traj_trigger' +
-                    "_{}".format(rank): '1' for rank in range(traj.world_size)}
-        triggers["Traj_trigger_{}".format(master_rank)] = '0'
-        r.mset(triggers)
-        while True:
-            time.sleep(0.1)
-            values = r.mget(triggers)
-            if all([_int(v) == 0 for v in values]):
-                break
+        obj = wire.dumps_traj(traj, compress, obs_dtype)
+        pipe = r.pipeline()
+        pipe.set('Traj', obj)
+        for _rank in range(traj.world_size):
+            if _rank != master_rank:
+                pipe.rpush('Traj_trigger' + "_{}".format(_rank), '1')
+        pipe.execute()
+        # waiting until all nodes read Traj before it is overwritten
+        for _ in range(traj.world_size - 1):
+            r.blpop('Traj_ack')
     else:
-        while True:
-            time.sleep(0.1)
-            trigger = r.get('Traj_trigger' +
-                            "_{}".format(rank))
-            if _int(trigger) == 1:
-                break
-        obj = cloudpickle.loads(r.get('Traj'))
-
-        traj.copy(obj)
-        r.set('Traj_trigger' + "_{}".format(rank), '0')
+        r.blpop('Traj_trigger' + "_{}".format(rank))
+        wire.loads_traj(r.get('Traj'), traj)
+        r.rpush('Traj_ack', rank)
 
     return traj
 
@@ -59,16 +58,19 @@ def sync(traj, master_rank=0):
 def update_pris(traj, td_loss, indices, alpha=0.6, epsilon=1e-6, update_epi_pris=False, seq_length=None, eta=0.9):
     """
     Update priorities specified in indices.
+    Priorities of all sequences in a batch can be updated in one call
+    by giving td_loss and indices of shape (seq_length, batch_size).
 
     Parameters
     ----------
     traj : Traj
     td_loss : torch.Tensor
     indices : torch.Tensor ot List of int
+        Same shape as td_loss.
     alpha : float
     epsilon : float
     update_epi_pris : bool
-        If True, all priorities of a episode including indices[0] are updated.
+        If True, seq_pris of all episodes including indices are updated.
     seq_length : int
         Length of batch.
     eta : float
@@ -77,25 +79,185 @@ def update_pris(traj, td_loss, indices, alpha=0.6, epsilon=1e-6, update_epi_pris
     -------
     traj : Traj
     """
+    indices = torch.as_tensor(indices, dtype=torch.long)
     pris = (torch.abs(td_loss) + epsilon) ** alpha
-    traj.data_map['pris'][indices] = pris.detach().to(traj.traj_device())
+    if indices.dim() == 2:
+        # sequences are ordered as they are updated one by one
+        indices = indices.t()
+        pris = pris.t()
+    indices = indices.reshape(-1).cpu().numpy()
+    pris = pris.detach().reshape(-1)
+    # steps shared by sequences get priorities of the last one
+    _, last = np.unique(indices[::-1], return_index=True)
+    last = len(indices) - 1 - last
+    indices = torch.as_tensor(indices[last])
+    traj.data_map['pris'][indices.to(traj.traj_device())] = pris[torch.as_tensor(last, device=pris.device)].to(
+        traj.traj_device(), traj.data_map['pris'].dtype)
+    traj.update_pri_trees('pris', indices)
 
     if update_epi_pris:
-        epi_start = -1
-        epi_end = -1
-        seq_start = indices[0]
-        for i in range(1, len(traj._epis_index)):
-            if seq_start < traj._epis_index[i]:
-                epi_start = traj._epis_index[i-1]
-                epi_end = traj._epis_index[i]
-                break
-
-        pris = traj.data_map['pris'][epi_start: epi_end]
-        n_seq = len(pris) - seq_length + 1
-        abs_pris = np.abs(pris.cpu().numpy())
-        seq_pris = np.array([eta * np.max(abs_pris[i:i+seq_length]) + (1 - eta) *
-                             np.mean(abs_pris[i:i+seq_length]) for i in range(n_seq)], dtype='float32')
-        traj.data_map['seq_pris'][epi_start:epi_start +
-                                  n_seq] = torch.tensor(seq_pris, dtype=torch.float, device=get_device())
+        epis_index = traj._epis_index
+        epis = np.unique(np.searchsorted(
+            epis_index, indices.numpy(), side='right') - 1)
+        starts = epis_index[epis]
+        lengths = epis_index[epis + 1] - starts
+        # steps of the episodes concatenated, and their positions in episodes
+        positions = np.arange(np.sum(lengths)) - \
+            np.repeat(np.cumsum(lengths) - lengths, lengths)
+        steps = np.repeat(starts, lengths) + positions
+        abs_pris = np.abs(
+            traj.data_map['pris'][torch.as_tensor(steps)].cpu().numpy())
+        seq_pris = ef.window_pris(abs_pris, seq_length, eta)
+        # windows lying in an episode
+        valid = positions[:len(seq_pris)] <= np.repeat(
+            lengths - seq_length, lengths)[:len(seq_pris)]
+        seq_pris = seq_pris[valid]
+        seq_indices = steps[:len(valid)][valid]
+        traj.data_map['seq_pris'][torch.as_tensor(seq_indices)] = torch.tensor(
+            seq_pris, dtype=traj.data_map['seq_pris'].dtype, device=traj.traj_device())
+        traj.update_pri_trees('seq_pris', seq_indices)
+
+    return traj
+
+
+def _discounted_scan(xs, discounts, chunk_size=SCAN_CHUNK_SIZE):
+    """
+    Reverse scan of ys[t] = xs[t] + discounts[t] * ys[t+1], where ys[T] = 0.
+    Steps are split into chunks which are scanned in parallel,
+    and values at the starts of chunks are scanned recursively in the same way.
+    So python loops are O(chunk_size * log(T)) instead of O(T).
+
+    Parameters
+    ----------
+    xs : torch.Tensor
+    discounts : torch.Tensor
+
+    Returns
+    -------
+    ys : torch.Tensor
+    """
+    num_step = len(xs)
+    if num_step <= chunk_size:
+        ys = torch.empty_like(xs)
+        carry = xs.new_zeros(())
+        for t in reversed(range(num_step)):
+            carry = xs[t] + discounts[t] * carry
+            ys[t] = carry
+        return ys
+    num_chunk = (num_step + chunk_size - 1) // chunk_size
+    pad = num_chunk * chunk_size - num_step
+    xs = torch.cat([xs, xs.new_zeros(pad)]).view(num_chunk, chunk_size)
+    discounts = torch.cat([discounts, discounts.new_zeros(pad)]).view(
+        num_chunk, chunk_size)
+    # scan in chunks without values from later chunks
+    local_ys = torch.empty_like(xs)
+    # discounts from each step to the start of the next chunk
+    coefs = torch.empty_like(discounts)
+    carry = xs.new_zeros(num_chunk)
+    coef = discounts.new_ones(num_chunk)
+    for t in reversed(range(chunk_size)):
+        carry = xs[:, t] + discounts[:, t] * carry
+        coef = discounts[:, t] * coef
+        local_ys[:, t] = carry
+        coefs[:, t] = coef
+    start_ys = _discounted_scan(local_ys[:, 0], coefs[:, 0], chunk_size)
+    next_start_ys = torch.cat([start_ys[1:], start_ys.new_zeros(1)])
+    ys = local_ys + coefs * next_start_ys.unsqueeze(1)
+    return ys.view(-1)[:num_step]
+
+
+def _epi_ends(traj, device):
+    return torch.as_tensor(traj._epis_index[1:] - 1, dtype=torch.long, device=device)
+
+
+def _set_data(traj, key, value):
+    if key in traj.data_map and traj.data_map[key].shape == value.shape:
+        traj.data_map[key].copy_(value)
+    else:
+        traj.data_map[key] = value
+
+
+def compute_rets(traj, gamma, last_vs=None):
+    """
+    Computing discounted cumulative returns of all registered episodes at once.
+    This gives the same results as epi_functional.compute_rets.
+
+    Parameters
+    ----------
+    traj : Traj
+    gamma : float
+        Discount rate
+    last_vs : None or ndarray or torch.Tensor
+        Values after the last steps of episodes, e.g. last_v of truncated segments.
+        If None, they are 0.
+
+    Returns
+    -------
+    traj : Traj
+    """
+    rews = traj.data_map['rews'].float()
+    ends = _epi_ends(traj, rews.device)
+    discounts = torch.full_like(rews, gamma)
+    discounts[ends] = 0
+    xs = rews.clone()
+    if last_vs is not None:
+        xs[ends] += gamma * torch.as_tensor(
+            last_vs, dtype=torch.float, device=rews.device).reshape(-1)
+    _set_data(traj, 'rets', _discounted_scan(xs, discounts))
+    return traj
 
+
+def compute_advs(traj, gamma, lam, last_vs=None):
+    """
+    Computing Generalized Advantage Estimation of all registered episodes at once.
+    This gives the same results as epi_functional.compute_advs.
+
+    Parameters
+    ----------
+    traj : Traj
+    gamma : float
+        Discount rate
+    lam : float
+        Bias-Variance trade-off parameter
+    last_vs : None or ndarray or torch.Tensor
+        Values after the last steps of episodes, e.g. last_v of truncated segments.
+        If None, they are 0.
+
+    Returns
+    -------
+    traj : Traj
+    """
+    rews = traj.data_map['rews'].float()
+    vs = traj.data_map['vs'].float().reshape(-1)
+    ends = _epi_ends(traj, rews.device)
+    next_vs = torch.cat([vs[1:], vs.new_zeros(1)])
+    if last_vs is not None:
+        next_vs[ends] = torch.as_tensor(
+            last_vs, dtype=torch.float, device=rews.device).reshape(-1)
+    else:
+        next_vs[ends] = 0
+    deltas = rews + gamma * next_vs - vs
+    discounts = torch.full_like(rews, gamma * lam)
+    discounts[ends] = 0
+    _set_data(traj, 'advs', _discounted_scan(deltas, discounts))
+    return traj
+
+
+def centerize_advs(traj, eps=1e-6):
+    """
+    Centerizing Advantage Function of all registered episodes.
+
+    Parameters
+    ----------
+    traj : Traj
+    eps : float
+        Small value for preventing 0 division.
+
+    Returns
+    -------
+    traj : Traj
+    """
+    advs = traj.data_map['advs']
+    _set_data(traj, 'advs', (advs - torch.mean(advs)) /
+              (torch.std(advs, unbiased=False) + eps))
     return traj
@@ -0,0 +1,280 @@
+"""
+Columnar binary format of episodes and trajectories sent between nodes.
+
+A message is
+magic, codec, length of header, json header and body.
+The body has a raw little-endian buffer per column,
+and columns are decoded by np.frombuffer without copy.
+The body can be compressed by lz4 or zstd, which are imported only when used.
+"""
+
+import json
+import struct
+
+import numpy as np
+import torch
+
+from machina.traj.traj import EPI_KEYS
+
+
+MAGIC = b'MCHN'
+# magic, version, codec, length of header
+PREFIX = struct.Struct('<4sBBxxI')
+VERSION = 1
+CODECS = (None, 'lz4', 'zstd')
+ALIGNMENT = 8
+
+# keys of observations, which can be sent in obs_dtype
+OB_KEYS = ('obs', 'next_obs', 'last_ob')
+
+
+def _compress(body, codec):
+    if codec is None:
+        return body
+    if codec == 'lz4':
+        try:
+            import lz4.frame
+        except ImportError:
+            raise ImportError(
+                'lz4 is not installed. Please install lz4 to use it.\n\n  $ pip install lz4\n')
+        return lz4.frame.compress(body)
+    if codec == 'zstd':
+        try:
+            import zstandard
+        except ImportError:
+            raise ImportError(
+                'zstandard is not installed. Please install zstandard to use it.\n\n  $ pip install zstandard\n')
+        return zstandard.ZstdCompressor().compress(body)
+    raise ValueError('Unknown codec: {}'.format(codec))
+
+
+def _decompress(body, codec):
+    if codec is None:
+        return body
+    if codec == 'lz4':
+        import lz4.frame
+        return lz4.frame.decompress(body)
+    if codec == 'zstd':
+        import zstandard
+        return zstandard.ZstdDecompressor().decompress(body)
+    raise ValueError('Unknown codec: {}'.format(codec))
+
+
+def dumps(columns, meta=None, compress=None, obs_dtype=None):
+    """
+    Encoding columns into bytes.
+
+    Parameters
+    ----------
+    columns : dict of ndarray
+    meta : dict or None
+        json serializable information sent with columns.
+    compress : str or None
+        None, 'lz4' or 'zstd'.
+    obs_dtype : str or None
+        If not None, columns of OB_KEYS are sent in this dtype, e.g. 'float16'.
+
+    Returns
+    -------
+    buf : bytes
+    """
+    specs = []
+    chunks = []
+    offset = 0
+    for key, arr in columns.items():
+        arr = np.asarray(arr)
+        cast = None
+        if obs_dtype is not None and key.split('/')[-1] in OB_KEYS:
+            cast = arr.dtype.str
+            arr = arr.astype(obs_dtype)
+        arr = np.ascontiguousarray(arr, dtype=arr.dtype.newbyteorder('<'))
+        pad = -offset % ALIGNMENT
+        if pad > 0:
+            chunks.append(b'\0' * pad)
+            offset += pad
+        specs.append(dict(key=key, dtype=arr.dtype.str, shape=list(arr.shape),
+                          offset=offset, cast=cast))
+        chunks.append(arr.tobytes())
+        offset += arr.nbytes
+    body = _compress(b''.join(chunks), compress)
+    header = json.dumps(dict(columns=specs, meta=meta)).encode('utf-8')
+    header += b' ' * (-(PREFIX.size + len(header)) % ALIGNMENT)
+    prefix = PREFIX.pack(MAGIC, VERSION, CODECS.index(compress), len(header))
+    return prefix + header + body
+
+
+def loads(buf):
+    """
+    Decoding bytes made by dumps.
+
+    Parameters
+    ----------
+    buf : bytes
+
+    Returns
+    -------
+    columns : dict of ndarray
+        Arrays are read-only views of buf unless it is compressed or cast.
+    meta : dict or None
+    """
+    magic, version, codec, header_length = PREFIX.unpack_from(buf, 0)
+    if magic != MAGIC or version != VERSION:
+        raise ValueError('Unknown message')
+    start = PREFIX.size + header_length
+    header = json.loads(bytes(buf[PREFIX.size:start]).decode('utf-8'))
+    codec = CODECS[codec]
+    if codec is None:
+        body = memoryview(buf)[start:]
+    else:
+        body = _decompress(bytes(buf[start:]), codec)
+    columns = dict()
+    for spec in header['columns']:
+        dtype = np.dtype(spec['dtype'])
+        shape = tuple(spec['shape'])
+        count = int(np.prod(shape))
+        arr = np.frombuffer(body, dtype=dtype, count=count,
+                            offset=spec['offset']).reshape(shape)
+        if spec['cast'] is not None:
+            arr = arr.astype(spec['cast'])
+        columns[spec['key']] = arr
+    return columns, header['meta']
+
+
+def _flatten(epi, prefix=''):
+    items = []
+    for key in epi:
+        if isinstance(epi[key], dict):
+            items += _flatten(epi[key], prefix + key + '/')
+        else:
+            items.append((prefix + key, epi[key]))
+    return items
+
+
+def dumps_epis(epis, compress=None, obs_dtype=None, meta=None):
+    """
+    Encoding epis into bytes.
+    Steps of all episodes are concatenated into a column per key.
+    Nested dicts such as a_is are flattened to keys joined by '/'.
+
+    Parameters
+    ----------
+    epis : list of dict
+    compress : str or None
+        None, 'lz4' or 'zstd'.
+    obs_dtype : str or None
+        If not None, observations are sent in this dtype, e.g. 'float16'.
+    meta : dict or None
+        json serializable information sent with epis.
+
+    Returns
+    -------
+    buf : bytes
+    """
+    lengths = [len(epi['rews']) for epi in epis]
+    columns = dict()
+    if len(epis) > 0:
+        flat_epis = [dict(_flatten(epi)) for epi in epis]
+        for key, _ in _flatten(epis[0]):
+            values = [flat_epi[key] for flat_epi in flat_epis]
+            if key in EPI_KEYS:
+                columns[key] = np.array(values)
+            else:
+                columns[key] = np.concatenate(
+                    [np.asarray(v) for v in values], axis=0)
+    return dumps(columns, dict(lengths=lengths, meta=meta), compress, obs_dtype)
+
+
+def loads_epis(buf, return_meta=False):
+    """
+    Decoding bytes made by dumps_epis.
+
+    Parameters
+    ----------
+    buf : bytes
+    return_meta : bool
+        If True, meta given to dumps_epis is also returned.
+
+    Returns
+    -------
+    epis : list of dict
+        Arrays are read-only views of buf unless it is compressed.
+    """
+    columns, meta = loads(buf)
+    bounds = np.concatenate([[0], np.cumsum(meta['lengths'])])
+    epis = []
+    for i in range(len(meta['lengths'])):
+        epi = dict()
+        for key, arr in columns.items():
+            *parents, name = key.split('/')
+            d = epi
+            for parent in parents:
+                d = d.setdefault(parent, dict())
+            if key in EPI_KEYS:
+                d[name] = arr[i]
+            else:
+                d[name] = arr[bounds[i]:bounds[i + 1]]
+        epis.append(epi)
+    if return_meta:
+        return epis, meta['meta']
+    return epis
+
+
+def dumps_traj(traj, compress=None, obs_dtype=None):
+    """
+    Encoding data of Traj into bytes.
+
+    Parameters
+    ----------
+    traj : Traj
+    compress : str or None
+        None, 'lz4' or 'zstd'.
+    obs_dtype : str or None
+        If not None, observations are sent in this dtype, e.g. 'float16'.
+
+    Returns
+    -------
+    buf : bytes
+    """
+    columns = dict([(key, value.detach().cpu().numpy())
+                    for key, value in traj.data_map.items()])
+    columns['_epis_index'] = np.asarray(traj._epis_index)
+    meta = dict(max_steps=int(traj.max_steps), _next_id=int(traj._next_id))
+    if hasattr(traj, 'pri_beta'):
+        meta['pri_beta'] = float(traj.pri_beta)
+    return dumps(columns, meta, compress, obs_dtype)
+
+
+def loads_traj(buf, traj):
+    """
+    Decoding bytes made by dumps_traj into traj.
+    Epis which are not registered are not sent.
+
+    Parameters
+    ----------
+    buf : bytes
+    traj : Traj
+
+    Returns
+    -------
+    traj : Traj
+    """
+    columns, meta = loads(buf)
+    traj._clear_caches()
+    traj.max_steps = meta['max_steps']
+    epis_index = np.array(columns.pop('_epis_index'))
+    data_map = dict()
+    for key, arr in columns.items():
+        value = torch.tensor(arr, device=traj.traj_device())
+        data_map[key] = value.to(traj._storage_dtype(key))
+    if getattr(traj, 'ring_buffer', False):
+        traj._head = traj._tail = 0
+        traj._epis_index = np.array([0])
+        traj._ring_add(data_map, epis_index)
+    else:
+        traj._epis_index = epis_index
+        traj.data_map = data_map
+    traj._next_id = meta['_next_id']
+    traj.current_epis = None
+    if 'pri_beta' in meta and hasattr(traj, 'pri_beta'):
+        traj.pri_beta = meta['pri_beta']
+    return traj
@@ -0,0 +1,83 @@
+import unittest
+
+import cloudpickle
+import numpy as np
+import torch
+import torch.multiprocessing as mp
+
+from machina.envs import GymEnv
+from machina.pols.random_pol import RandomPol
+from machina.prepro import BasePrePro, RunningMeanStd
+from machina.samplers import EpiSampler
+
+
+def _update(rms, xs):
+    for x in xs:
+        rms.update(x)
+
+
+class TestPrePro(unittest.TestCase):
+
+    def test_running_mean_std(self):
+        xs = np.random.randn(100, 3) * 2 + 1
+        rms = RunningMeanStd((3, ))
+        for batch in np.split(xs, [10, 11, 60]):
+            rms.update(batch)
+        assert np.allclose(rms.mean, np.mean(xs, axis=0))
+        assert np.allclose(rms.var, np.var(xs, axis=0))
+        assert rms.count == 100
+
+        other = RunningMeanStd((3, ))
+        other.update(torch.tensor(xs[:40]))
+        merged = RunningMeanStd((3, ))
+        merged.update(xs[40:])
+        merged.merge(other)
+        assert np.allclose(merged.mean, rms.mean)
+        assert np.allclose(merged.var, rms.var)
+
+        normalized = rms.normalize_(torch.tensor(xs))
+        assert np.allclose(normalized.numpy(), rms.normalize(xs))
+
+    def test_share_memory(self):
+        xs = np.random.randn(2, 10, 3)
+        rms = RunningMeanStd((3, )).share_memory()
+        processes = [mp.Process(target=_update, args=(rms, x)) for x in xs]
+        for p in processes:
+            p.start()
+        for p in processes:
+            p.join()
+        assert rms.count == 20
+        assert np.allclose(rms.mean, np.mean(xs.reshape(-1, 3), axis=0))
+
+    def test_pickle_shared(self):
+        rms = RunningMeanStd((3, )).share_memory()
+        rms.update(np.random.randn(10, 3))
+        loaded = cloudpickle.loads(cloudpickle.dumps(rms))
+        assert np.allclose(loaded.mean, rms.mean)
+        loaded.update(np.random.randn(10, 3))
+        assert loaded.count == 20
+
+    def test_sampler_prepro(self):
+        env = GymEnv('Pendulum-v0')
+        pol = RandomPol(env.observation_space, env.action_space)
+        prepro = BasePrePro(env.observation_space)
+        sampler = EpiSampler(env, pol, num_parallel=2,
+                             prepro=prepro.prepro_with_update)
+        epis = sampler.sample(pol, max_epis=2)
+        # statistics updated in sampling processes are shared
+        assert prepro.ob_rms.count >= sum([len(epi['obs']) for epi in epis])
+        del sampler
+
+    def test_base_prepro(self):
+        env = GymEnv('Pendulum-v0')
+        prepro = BasePrePro(env.observation_space)
+        obs = np.random.randn(10, 3)
+        for ob in obs:
+            prepro.prepro_with_update(ob)
+        assert np.allclose(prepro.ob_rm, np.mean(obs, axis=0))
+        assert np.allclose(prepro.ob_rv, np.var(obs, axis=0))
+        assert prepro.prepro(obs).shape == obs.shape
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -5,10 +5,14 @@ import unittest
 
 import numpy as np
 import psutil
+import torch
+import torch.nn as nn
 
 from machina.traj import Traj
 from machina.envs import GymEnv
 from machina.samplers import EpiSampler, DistributedEpiSampler
+from machina.samplers.epi_sampler import EnvRunner
+from machina.samplers.param_store import ParamStore, decode_params, encode_params, flatten
 from machina.pols.random_pol import RandomPol
 from machina.utils import make_redis
 
@@ -28,6 +32,99 @@ class TestTraj(unittest.TestCase):
         epis = sampler.sample(self.pol, max_epis=2)
         assert len(epis) >= 2
 
+    def test_epi_sampler_vec_env(self):
+        sampler = EpiSampler(self.env, self.pol, num_parallel=1,
+                             num_env_per_process=3)
+        epis = sampler.sample(self.pol, max_epis=2)
+        assert len(epis) >= 2
+        for epi in epis:
+            assert len(epi['obs']) == len(epi['acs']) == len(epi['rews'])
+
+    def test_epi_sampler_max_epis(self):
+        sampler = EpiSampler(self.env, self.pol, num_parallel=2,
+                             num_env_per_process=3)
+        epis = sampler.sample(self.pol, max_epis=4)
+        assert len(epis) == 4
+
+    def test_env_runner_idle_env(self):
+        envs = [GymEnv('Pendulum-v0') for _ in range(2)]
+        runner = EnvRunner(envs, self.pol)
+        flags = iter([True, False])
+
+        def start():
+            return next(flags, False)
+
+        epis = []
+        while True:
+            epis += runner.step(start=start)
+            if not runner.running:
+                break
+        assert len(epis) == 1
+        assert epis[0]['obs'].shape[1:] == self.env.observation_space.shape
+
+    def test_epi_sampler_inference_server(self):
+        sampler = EpiSampler(self.env, self.pol, num_parallel=2,
+                             num_env_per_process=2, inference_server=True)
+        epis = sampler.sample(self.pol, max_epis=2)
+        assert len(epis) >= 2
+
+    def test_epi_sampler_async(self):
+        sampler = EpiSampler(self.env, self.pol, num_parallel=2)
+        handle = sampler.sample_async(self.pol, max_epis=2)
+        epis = handle.result()
+        assert len(epis) >= 2
+
+        handle = sampler.start_actor(self.pol)
+        epis = []
+        while len(epis) < 2:
+            epis += [dict(rews=np.array(epi['rews']))
+                     for epi in handle.drain()]
+            sampler.publish(self.pol)
+        handle.stop()
+        assert handle.done()
+        epis = sampler.sample(self.pol, max_epis=2)
+        assert len(epis) >= 2
+
+    def test_epi_sampler_steps(self):
+        sampler = EpiSampler(self.env, self.pol, num_parallel=2,
+                             num_env_per_process=2)
+        for _ in range(3):
+            epis = sampler.sample_steps(self.pol, 150)
+            assert sum([len(epi['rews']) for epi in epis]) == 2 * 150
+            for epi in epis:
+                assert epi['truncated'] == (epi['dones'][-1] == 0)
+                assert epi['last_ob'].shape == self.env.observation_space.shape
+        traj = Traj()
+        traj.add_epis(epis)
+        traj.register_epis()
+        assert traj.num_step == 2 * 150
+
+    def test_param_store(self):
+        src = nn.Linear(3, 2)
+        dst = nn.Linear(3, 2)
+        store = ParamStore(src)
+        version = store.pull(dst)
+        assert torch.equal(flatten(src), flatten(dst))
+        assert store.pull(dst, version) == version
+        with torch.no_grad():
+            src.weight.add_(1)
+        store.publish(src)
+        assert store.pull(dst, version) != version
+        assert torch.equal(flatten(src), flatten(dst))
+
+        ref = flatten(dst)
+        received = ref.clone()
+        numels = [p.numel() for p in src.parameters()]
+        with torch.no_grad():
+            src.bias.add_(1)
+        payload = encode_params(flatten(src), ref, numels, delta=True)
+        assert payload[0] == [1]
+        decode_params(payload, received, numels)
+        assert torch.equal(received, flatten(src))
+        payload = encode_params(flatten(src), ref, numels, 'float16')
+        decode_params(payload, received, numels)
+        assert torch.equal(received, ref)
+
     def test_distributed_epi_sampler(self):
         proc_redis = subprocess.Popen(['redis-server'])
         proc_slave = subprocess.Popen(['python', '-m', 'machina.samplers.distributed_epi_sampler',
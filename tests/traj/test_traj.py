@@ -1,11 +1,24 @@
+import os
+import shutil
+import tempfile
 import unittest
 
+import gym
 import numpy as np
+import torch
 
 from machina.traj import Traj
+from machina.traj import wire
+from machina.traj.traj import RANK_RESORT_INTERVAL
+from machina.traj import traj_functional as tf
+from machina.traj import epi_functional as ef
+from machina.traj.sum_tree import SumTree
 from machina.envs import GymEnv
 from machina.samplers import EpiSampler
 from machina.pols.random_pol import RandomPol
+from machina.vfuncs import DeterministicSVfunc, DeterministicSAVfunc
+
+from simple_net import QNetLSTM
 
 
 class TestTraj(unittest.TestCase):
@@ -24,12 +37,390 @@ class TestTraj(unittest.TestCase):
         cls.traj.add_epis(epis)
         cls.traj.register_epis()
 
+    def test_wire(self):
+        epis = [dict(obs=np.random.randn(3, 2).astype('float32'), rews=np.ones(3),
+                     a_is=dict(mean=np.zeros((3, 1))), truncated=True, last_ob=np.ones(2)),
+                dict(obs=np.random.randn(2, 2).astype('float32'), rews=np.zeros(2),
+                     a_is=dict(mean=np.ones((2, 1))), truncated=False, last_ob=np.zeros(2))]
+        decoded = wire.loads_epis(wire.dumps_epis(epis))
+        for epi, d in zip(epis, decoded):
+            assert np.array_equal(epi['obs'], d['obs'])
+            assert np.array_equal(epi['rews'], d['rews'])
+            assert np.array_equal(epi['a_is']['mean'], d['a_is']['mean'])
+            assert epi['truncated'] == d['truncated']
+            assert np.array_equal(epi['last_ob'], d['last_ob'])
+        decoded, meta = wire.loads_epis(wire.dumps_epis(
+            epis, obs_dtype='float16', meta=dict(rank=1)), return_meta=True)
+        assert meta['rank'] == 1
+        assert decoded[0]['obs'].dtype == np.float32
+        assert np.allclose(epis[0]['obs'], decoded[0]['obs'], atol=1e-2)
+
+        new_traj = wire.loads_traj(wire.dumps_traj(self.traj), Traj())
+        assert new_traj.num_epi == self.traj.num_epi
+        for key in self.traj.data_map:
+            assert np.array_equal(
+                self.traj.data_map[key].numpy(), new_traj.data_map[key].numpy())
+
     def test_add_traj(self):
         new_traj = Traj()
         new_traj.add_traj(self.traj)
         assert new_traj.num_epi == self.traj.num_epi
         assert new_traj.num_step == self.traj.num_step
 
+    def test_ring_buffer(self):
+        max_steps = self.traj.num_step * 2 + 1
+        traj = Traj(max_steps)
+        ring_traj = Traj(max_steps, ring_buffer=True, ring_slack=3)
+        for _ in range(5):
+            traj.add_traj(self.traj)
+            ring_traj.add_traj(self.traj)
+            assert np.array_equal(traj._epis_index, ring_traj._epis_index)
+            for key in traj.data_map:
+                assert np.array_equal(
+                    traj.data_map[key].numpy(), ring_traj.data_map[key].numpy())
+        # storage is allocated once
+        assert ring_traj._ring_capacity() == max_steps + 3
+        batch = ring_traj.random_batch_once(8)
+        for batch in ring_traj.iterate(8):
+            pass
+
+    def test_ring_buffer_over_max_steps(self):
+        epis = [dict(obs=np.full((length, 3), length, dtype='float32'), rews=np.zeros(length))
+                for length in [40, 50, 60]]
+        traj = Traj(100, ring_buffer=True)
+        traj.add_epis(epis)
+        traj.register_epis()
+        # only the newest episode fits in max_steps
+        assert np.array_equal(traj._epis_index, [0, 60])
+        assert torch.all(traj.data_map['obs'] == 60)
+        traj.add_epis(epis[:1])
+        traj.register_epis()
+        assert np.array_equal(traj._epis_index, [0, 60, 100])
+        traj.add_epis([dict(obs=np.zeros((101, 3)), rews=np.zeros(101))])
+        with self.assertRaises(ValueError):
+            traj.register_epis()
+
+    def test_storage_dir(self):
+        storage_dir = tempfile.mkdtemp()
+        try:
+            traj = Traj(max_steps=500, storage_dir=storage_dir)
+            traj.add_traj(self.traj)
+            traj.add_traj(self.traj)
+            # reopening the buffer
+            reopened = Traj(max_steps=500, storage_dir=storage_dir)
+            assert np.all(reopened._epis_index == traj._epis_index)
+            for key in traj.data_map:
+                assert torch.equal(reopened.data_map[key], traj.data_map[key])
+            for batch, indices in reopened.random_batch(8, return_indices=True):
+                assert torch.equal(
+                    batch['obs'], traj.data_map['obs'][indices])
+        finally:
+            shutil.rmtree(storage_dir)
+
+    def test_storage_dir_crash(self):
+        storage_dir = tempfile.mkdtemp()
+        try:
+            traj = Traj(max_steps=50, ring_slack=10, storage_dir=storage_dir)
+            for i in range(6):
+                traj.add_epis(
+                    [dict(obs=np.full((10, 3), i), rews=np.zeros(10))])
+                traj.register_epis()
+
+            def crash(epis_index):
+                raise RuntimeError
+            # live data is moved at this registration and it crashes before commit
+            traj._ring_commit = crash
+            traj.add_epis([dict(obs=np.full((10, 3), 6), rews=np.zeros(10))])
+            with self.assertRaises(RuntimeError):
+                traj.register_epis()
+
+            reopened = Traj(max_steps=50, storage_dir=storage_dir)
+            ids = [int(epi['obs'][0, 0])
+                   for epi in reopened.iterate_epi(shuffle=False)]
+            assert ids == [2, 3, 4, 5]
+            for epi, i in zip(reopened.iterate_epi(shuffle=False), ids):
+                assert torch.all(epi['obs'] == i)
+            assert sorted(os.listdir(storage_dir)) == [
+                'index.json', 'obs.2.npy', 'rews.2.npy']
+        finally:
+            shutil.rmtree(storage_dir)
+
+    def test_storage_dtypes(self):
+        for ring_buffer in (False, True):
+            traj = Traj(ring_buffer=ring_buffer,
+                        storage_dtypes=dict(obs='float16', dones='uint8'))
+            traj.add_traj(self.traj)
+            assert traj.data_map['obs'].dtype == torch.float16
+            assert traj.data_map['dones'].dtype == torch.uint8
+            for batch, indices in traj.random_batch(8, return_indices=True):
+                assert batch['obs'].dtype == torch.float
+                assert torch.allclose(
+                    batch['obs'], self.traj.data_map['obs'][indices], atol=1e-2)
+                assert torch.equal(
+                    batch['dones'], self.traj.data_map['dones'][indices])
+
+    def test_register_epis(self):
+        epis = []
+        for length in [3, 5, 2]:
+            epis.append(dict(obs=np.random.randn(length, 3), acs=np.random.randn(length, 1),
+                             rews=np.random.randn(length), dones=np.zeros(length),
+                             a_is=dict(mean=np.random.randn(length, 1))))
+        traj = Traj(traj_device='cpu')
+        for _ in range(2):
+            traj.add_epis(epis)
+            traj.register_epis()
+        assert np.all(traj._epis_index == [0, 3, 8, 10, 13, 18, 20])
+        obs = np.concatenate([epi['obs'] for epi in epis] * 2)
+        mean = np.concatenate([epi['a_is']['mean'] for epi in epis] * 2)
+        assert torch.allclose(traj.data_map['obs'], torch.tensor(
+            obs, dtype=torch.float))
+        assert torch.allclose(traj.data_map['mean'], torch.tensor(
+            mean, dtype=torch.float))
+
+    def test_iterate_epi(self):
+        epis = list(self.traj.iterate_epi(shuffle=False))
+        assert len(epis) == self.traj.num_epi
+        lengths = self.traj.epi_lengths()
+        sums = self.traj.epi_sums('rews')
+        maxes = self.traj.epi_maxes('rews')
+        for epi, length, s, m in zip(epis, lengths, sums, maxes):
+            assert set(epi.keys()) == set(self.traj.data_map.keys())
+            assert len(epi['rews']) == length
+            assert np.isclose(float(epi['rews'].sum()), s, atol=1e-4)
+            assert float(epi['rews'].max()) == m
+
+    def test_compute_rets_advs(self):
+        epis = []
+        for length in [3, 1, 100, 64, 65]:
+            epis.append(dict(obs=np.random.randn(length, 3), rews=np.random.randn(length).astype('float32'),
+                             dones=np.zeros(length), vs=np.random.randn(length).astype('float32')))
+        last_vs = np.random.randn(len(epis)).astype('float32')
+        traj = Traj(traj_device='cpu')
+        traj.add_epis(epis)
+        traj.register_epis()
+        traj = tf.compute_rets(traj, 0.99, last_vs)
+        traj = tf.compute_advs(traj, 0.99, 0.95, last_vs)
+        traj = tf.centerize_advs(traj)
+
+        epis = [dict(epi, last_v=last_v, truncated=True)
+                for epi, last_v in zip(epis, last_vs)]
+        epis = ef.compute_rets(epis, 0.99)
+        epis = ef.compute_advs(epis, 0.99, 0.95)
+        epis = ef.centerize_advs(epis)
+        assert np.allclose(traj.data_map['rets'].numpy(), np.concatenate(
+            [epi['rets'] for epi in epis]), atol=1e-4)
+        assert np.allclose(traj.data_map['advs'].numpy(), np.concatenate(
+            [epi['advs'] for epi in epis]), atol=1e-4)
+
+    def test_compute_vs(self):
+        vf = DeterministicSVfunc(
+            self.env.observation_space, torch.nn.Linear(self.env.observation_space.shape[0], 1))
+        epis = []
+        for length in [3, 5, 2]:
+            epis.append(dict(obs=np.random.randn(length, 3).astype('float32'),
+                             truncated=True, last_ob=np.random.randn(3).astype('float32')))
+        epis = ef.compute_vs(epis, vf)
+        for epi in epis:
+            with torch.no_grad():
+                vs = vf(torch.tensor(epi['obs']))[0].numpy()
+                last_v = vf(torch.tensor(epi['last_ob'][None]))[0].numpy()
+            assert np.allclose(epi['vs'], vs, atol=1e-6)
+            assert np.allclose(epi['last_v'], last_v[0], atol=1e-6)
+
+    def test_compute_hs(self):
+        ob_space = gym.spaces.Box(-1, 1, (3, ), dtype=np.float32)
+        ac_space = gym.spaces.Box(-1, 1, (1, ), dtype=np.float32)
+        qf = DeterministicSAVfunc(ob_space, ac_space, QNetLSTM(
+            ob_space, ac_space, h_size=8, cell_size=4), rnn=True)
+        epis = []
+        for length in [3, 5, 2]:
+            epis.append(dict(obs=np.random.randn(length, 3).astype('float32'),
+                             acs=np.random.randn(length, 1).astype('float32')))
+        epis = ef.compute_hs(epis, qf, hs_name='q_hs', input_acs=True)
+        for epi in epis:
+            qf.reset()
+            with torch.no_grad():
+                for i in range(len(epi['obs'])):
+                    hs = qf(torch.tensor(epi['obs'][i:i + 1]).unsqueeze(1),
+                            torch.tensor(epi['acs'][i:i + 1]).unsqueeze(1))[-1]['hs']
+                    assert np.allclose(
+                        epi['q_hs'][i], torch.cat(hs).numpy(), atol=1e-6)
+
+    def test_normalize_obs_and_acs(self):
+        epis = []
+        for length in [3, 5, 2]:
+            obs = np.random.randn(length + 1, 3) * 2 + 1
+            epis.append(dict(obs=obs[:-1], next_obs=obs[1:],
+                             acs=np.random.randn(length, 1), rews=np.zeros(length)))
+        obs = np.concatenate([epi['obs'] for epi in epis])
+        acs = np.concatenate([epi['acs'] for epi in epis])
+        traj = Traj()
+        traj.add_epis([dict(epi) for epi in epis])
+        traj, mean_obs, std_obs, mean_acs, std_acs = ef.normalize_obs_and_acs(
+            traj)
+        assert np.allclose(mean_obs, np.mean(obs, axis=0, keepdims=True))
+        assert np.allclose(std_obs, np.std(obs, axis=0, keepdims=True) + 1e-6)
+        assert np.allclose(std_acs, np.std(acs, axis=0, keepdims=True) + 1e-6)
+        traj.register_epis()
+
+        registered = Traj()
+        registered.add_epis(epis)
+        registered.register_epis()
+        registered = ef.normalize_obs_and_acs(
+            registered, mean_obs, std_obs, mean_acs, std_acs, return_statistic=False)
+        for key in ['obs', 'next_obs', 'acs']:
+            assert torch.allclose(
+                registered.data_map[key], traj.data_map[key], atol=1e-5)
+
+    def test_lazy_next_obs(self):
+        epis = []
+        for length in [3, 5, 2]:
+            dones = np.zeros(length)
+            dones[-1] = 1
+            epis.append(dict(obs=np.random.randn(length, 3), acs=np.random.randn(length, 1),
+                             rews=np.random.randn(length), dones=dones))
+        traj = Traj()
+        traj.add_epis([dict(epi) for epi in epis])
+        traj = ef.add_next_obs(traj)
+        traj.register_epis()
+        lazy_traj = Traj(lazy_next_obs=True)
+        lazy_traj.add_epis(epis)
+        lazy_traj = ef.add_next_obs(lazy_traj)
+        lazy_traj.register_epis()
+        assert 'next_obs' not in lazy_traj.data_map
+
+        batch, indices = lazy_traj.random_batch_once(
+            traj.num_step, torch.arange(traj.num_step), return_indices=True)
+        assert torch.equal(
+            batch['next_obs'], traj.data_map['next_obs'][indices])
+        batch = next(lazy_traj.full_batch())
+        assert torch.equal(batch['next_obs'], traj.data_map['next_obs'])
+
+        # next_obs is materialized or dropped by add_traj
+        for ring_buffer in (False, True):
+            eager = Traj(ring_buffer=ring_buffer)
+            eager.add_traj(lazy_traj)
+            assert torch.equal(
+                eager.data_map['next_obs'], traj.data_map['next_obs'])
+            lazy = Traj(ring_buffer=ring_buffer, lazy_next_obs=True)
+            lazy.add_traj(traj)
+            assert 'next_obs' not in lazy.data_map
+            batch = next(lazy.full_batch())
+            assert torch.equal(batch['next_obs'], traj.data_map['next_obs'])
+
+    def test_sum_tree(self):
+        pris = np.random.uniform(size=37)
+        pris[3] = 0
+        tree = SumTree(pris)
+        assert np.isclose(tree.total, pris.sum())
+        assert tree.min == np.min(pris[pris > 0])
+        values = np.random.uniform(size=100) * pris.sum()
+        assert np.array_equal(tree.find(values), np.searchsorted(
+            np.cumsum(pris), values, side='right'))
+        pris[[1, 5, 5, 36]] = [2., 3., 3., 0.5]
+        tree.update([1, 5, 5, 36], [2., 3., 3., 0.5])
+        assert np.isclose(tree.total, pris.sum())
+        assert 3 not in tree.sample(1000)[0]
+        tree.grow(50)
+        tree.update([49], [1.])
+        assert np.isclose(tree.total, pris.sum() + 1.)
+        assert np.array_equal(tree.get(np.arange(37)), pris)
+
+    def test_prioritized_random_batch_once(self):
+        traj = Traj()
+        traj.add_traj(self.traj)
+        traj.data_map['pris'] = torch.ones(traj.num_step)
+        for mode in ('proportional', 'rank_based'):
+            batch, indices = traj.prioritized_random_batch_once(
+                8, return_indices=True, mode=mode)
+            assert batch['is_weights'].shape == (8, )
+            tf.update_pris(traj, torch.zeros(8), indices)
+
+    def test_rank_based_update(self):
+        traj = Traj()
+        traj.add_traj(self.traj)
+        traj.data_map['pris'] = torch.ones(traj.num_step)
+        traj.prioritized_random_batch_once(8, mode='rank_based')
+        rank_sampler = traj._rank_sampler
+        tf.update_pris(traj, torch.tensor([1e6]), torch.tensor([7]))
+        # stale ranks are used until RANK_RESORT_INTERVAL updates
+        traj.prioritized_random_batch_once(8, mode='rank_based')
+        assert traj._rank_sampler is rank_sampler
+        for _ in range(RANK_RESORT_INTERVAL - 1):
+            tf.update_pris(traj, torch.tensor([1e6]), torch.tensor([7]))
+        counts = np.zeros(traj.num_step)
+        for _ in range(100):
+            _, indices = traj.prioritized_random_batch_once(
+                128, return_indices=True, mode='rank_based')
+            np.add.at(counts, indices.numpy(), 1)
+        assert np.argmax(counts) == 7
+
+    def test_pri_trees_add(self):
+        epis = [dict(obs=np.zeros((10, 3)), rews=np.zeros(10), pris=np.full(10, i + 1.))
+                for i in range(10)]
+        traj = Traj()
+        ring_traj = Traj(50, ring_buffer=True, ring_slack=20)
+        trees = []
+        for epi in epis:
+            for t in (traj, ring_traj):
+                t.add_epis([epi])
+                t.register_epis()
+                indices, _, _ = t._sample_pri_tree('pris', 100)
+                pris = t.data_map['pris'].numpy()
+                tree = t._pri_trees['pris']
+                assert np.isclose(tree.total, pris.sum())
+                assert np.all(pris[indices] > 0)
+            trees.append(traj._pri_trees['pris'])
+        # leaves of added steps are updated without building the tree again
+        tree = trees[0]
+        assert all([t is tree for t in trees])
+        assert np.allclose(tree.get(np.arange(traj.num_step)),
+                           traj.data_map['pris'].numpy())
+        # evicted steps are not sampled
+        assert ring_traj._head > 0
+        indices, _, _ = ring_traj._sample_pri_tree('pris', 1000)
+        assert np.all(ring_traj.data_map['pris'].numpy()[indices] >= 6)
+
+    def test_window_pris(self):
+        pris = np.random.uniform(size=23)
+        for seq_length in [1, 4, 7, 23]:
+            seq_pris = ef.window_pris(pris, seq_length, eta=0.9)
+            expected = [0.9 * np.max(pris[i:i+seq_length]) + 0.1 * np.mean(pris[i:i+seq_length])
+                        for i in range(len(pris) - seq_length + 1)]
+            assert np.allclose(seq_pris, expected, atol=1e-6)
+        assert len(ef.window_pris(pris[:3], 4)) == 0
+
+    def test_update_seq_pris(self):
+        seq_length = 4
+        epis = [dict(rews=np.zeros(length), pris=np.random.uniform(size=length).astype('float32'))
+                for length in [6, 3, 9, 5]]
+        epis = ef.compute_seq_pris(epis, seq_length)
+        traj = Traj()
+        traj.add_epis([dict(epi) for epi in epis])
+        traj.register_epis()
+        sequential = Traj()
+        sequential.add_epis(epis)
+        sequential.register_epis()
+
+        # sequences in the 1st, 3rd and 4th episodes
+        indices = torch.tensor([1, 11, 18]).unsqueeze(
+            0) + torch.arange(3).unsqueeze(1)
+        td_loss = torch.randn(3, 3)
+        tf.update_pris(traj, td_loss, indices,
+                       update_epi_pris=True, seq_length=seq_length)
+        for i in range(3):
+            tf.update_pris(sequential, td_loss[:, i], indices[:, i],
+                           update_epi_pris=True, seq_length=seq_length)
+        for key in ['pris', 'seq_pris']:
+            assert torch.allclose(
+                traj.data_map[key], sequential.data_map[key], atol=1e-6)
+        start, end = traj._epis_index[2], traj._epis_index[3]
+        assert torch.all(traj.data_map['seq_pris']
+                         [end - seq_length + 1:end] == 0)
+        pris = traj.data_map['pris'][start:end].numpy()
+        assert np.allclose(traj.data_map['seq_pris'][start:end - seq_length + 1].numpy(),
+                           ef.window_pris(pris, seq_length), atol=1e-6)
+
     def test_random_batch_once(self):
         batch_size = 32
         data_map = self.traj.random_batch_once(
@@ -44,6 +435,56 @@ class TestTraj(unittest.TestCase):
         data_map, indices = self.traj.random_batch_once(
             batch_size, indices=np.arange(5), return_indices=True)
 
+    def test_random_batch_rnn(self):
+        seq_length = 20
+        for batch in self.traj.random_batch_rnn(4, seq_length, epoch=2):
+            assert batch['obs'].shape == (seq_length, 4) + \
+                self.env.observation_space.shape
+            assert batch['out_masks'].shape == (seq_length, 4)
+            assert torch.all(batch['rews'][batch['out_masks'] == 0] == 0)
+
+    def test_iterate_rnn(self):
+        epis = []
+        for length in [3, 5, 2, 7, 4]:
+            dones = np.zeros(length)
+            dones[-1] = 1
+            epis.append(dict(obs=np.random.randn(length, 3), acs=np.random.randn(length, 1),
+                             rews=np.arange(1, length + 1, dtype=float), dones=dones))
+        traj = Traj(padded_layout=True)
+        traj.add_epis(epis)
+        traj.register_epis()
+        num_epi_per_seq = 2
+        for batch in traj.iterate_rnn(2, num_epi_per_seq, epoch=3):
+            assert batch['obs'].shape[1:] == (2, 3)
+            lengths = batch['out_masks'].sum(0).long()
+            assert batch['obs'].size(0) == int(lengths.max())
+            for i, length in enumerate(lengths):
+                assert torch.all(batch['out_masks'][:length, i] == 1)
+                assert torch.all(batch['rews'][length:, i] == 0)
+                # sequences are made of whole episodes
+                assert int(batch['dones'][:length, i].sum()) == num_epi_per_seq
+                assert batch['dones'][length - 1, i] == 1
+
+    def test_prefetch(self):
+        traj = Traj(prefetch=True)
+        traj.copy(self.traj)
+        for batch, indices in traj.random_batch(8, epoch=2, return_indices=True):
+            assert torch.all(
+                batch['obs'] == self.traj.data_map['obs'][indices])
+        num_batch = len(list(traj.iterate(8, epoch=1)))
+        assert num_batch == self.traj.num_step // 8
+
+        # prioritized batches are sampled after priorities are updated
+        traj.data_map['pris'] = torch.ones(traj.num_step)
+        iterator = traj.prioritized_random_batch(
+            8, epoch=2, return_indices=True)
+        batch, indices = next(iterator)
+        traj.data_map['pris'][:] = 0
+        traj.data_map['pris'][7] = 1
+        traj.update_pri_trees('pris', np.arange(traj.num_step))
+        batch, indices = next(iterator)
+        assert torch.all(indices == 7)
+
     def test_random_batch(self):
         batch_size = 32
         iterator = self.traj.random_batch(batch_size)